@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Benchmark Tool
+
+This script times the ucdtool.py subcommands and the ucdtools.notebook
+functions on synthetic classes of several sizes, and saves the results as
+JSON so that runs can be compared. To use it, run
+
+    python bench/bench.py --sizes 10 50 200 -o results.json
+
+and add '--baseline OLD.json' to print how the results compare to an earlier
+run. Everything runs on local repos, so no network or GitHub account is
+needed. The startup time of ucdtool.py is recorded too; see startup.py to
+check it against a budget.
+"""
+import argparse
+import contextlib
+import copy
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import nbformat as nb
+import pandas as pd
+import pygit2
+
+import startup
+import synthetic
+
+# Make ucdtool.py and the ucdtools package importable.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config as cfg
+import ucdtool
+import ucdtools.notebook as note
+
+ASSIGNMENT = "hw1"
+DUE = "02.12 16:00"
+
+
+def run_tool(*argv):
+    """Run ucdtool.py with the given arguments, and return the time taken in
+    seconds. The tool's output is discarded.
+    """
+    argv = [str(x) for x in argv]
+    with open(os.devnull, "wt") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            ucdtool.main(argv)
+            return time.perf_counter() - start
+
+
+def time_call(fn, setup = None, repeat = 5):
+    """Time fn(*setup()) repeat times, not counting setup.
+
+    Returns a dict with the minimum and median times in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def bench_class(root, size, args):
+    """Generate a class with size students in root, then time each ucdtool.py
+    subcommand on it, in the order they're used during grading.
+
+    Returns a dict of times in seconds.
+    """
+    origins, users, canvas = synthetic.make_class(root, size, ASSIGNMENT,
+            args.cells, args.output_size, args.image_every)
+    dest = root / "repos"
+
+    cfg.base_url = origins.as_uri() + "/"
+    cfg.users = str(users)
+
+    jobs = ["--jobs", args.jobs]
+    times = {}
+    times["clone"] = run_tool("clone", dest, ASSIGNMENT, users, *jobs)
+    times["clone --update"] = run_tool("clone", dest, ASSIGNMENT, users,
+            "--update", *jobs)
+    times["prepare"] = run_tool("prepare", dest, DUE, "--rubric", *jobs)
+    times["prepare (unchanged)"] = run_tool("prepare", dest, DUE, "--rubric",
+            *jobs)
+    times["late"] = run_tool("late", dest, DUE, "-o", root / "late.csv",
+            *jobs)
+
+    # Grade every notebook, as the TAs would.
+    for i, path in enumerate(sorted(dest.iterdir())):
+        if (path / "feedback.ipynb").exists():
+            synthetic.fill_rubric(path, seed = i)
+
+    times["grade"] = run_tool("grade", dest, ASSIGNMENT, canvas, *jobs)
+    times["grade (cached)"] = run_tool("grade", dest, ASSIGNMENT, canvas,
+            *jobs)
+    times["commit"] = run_tool("commit", dest, "feedback.ipynb",
+            "Add feedback")
+    times["push"] = run_tool("push", dest, *jobs)
+
+    return times
+
+
+def bench_notebook(root, args):
+    """Time the ucdtools.notebook functions on one synthetic notebook.
+
+    Returns a dict of times for each function.
+    """
+    root.mkdir(parents = True, exist_ok = True)
+    path = root / "hw1.ipynb"
+    path.write_text(synthetic.make_notebook(args.cells, args.output_size,
+        args.image_every))
+
+    notebook = note.read_notebook(path)
+    note.prepare_repo(root, rubric = True)
+    synthetic.fill_rubric(root)
+    feedback = root / "feedback.ipynb"
+
+    def fresh():
+        return (copy.deepcopy(notebook),)
+
+    repeat = args.repeat
+    times = {
+        "read_notebook": time_call(note.read_notebook, lambda: (path,),
+            repeat),
+        "nbformat.read": time_call(nb.read, lambda: (str(path), 4), repeat),
+        "validate (full)": time_call(note.validate,
+            lambda: (notebook, True), repeat),
+        "validate (structural)": time_call(note.validate,
+            lambda: (notebook, False), repeat),
+        "add_grade_cells": time_call(note.add_grade_cells, fresh, repeat),
+        "cap_outputs": time_call(note.cap_outputs,
+            lambda: fresh() + (1000,), repeat),
+        "write_notebook": time_call(note.write_notebook,
+            lambda: (notebook, root / "out.ipynb"), repeat),
+        "blob_oid": time_call(note.blob_oid, lambda: (path,), repeat),
+        "find_grade_cell": time_call(note.find_grade_cell,
+            lambda: (feedback,), repeat),
+        "grade_repo": time_call(note.grade_repo, lambda: (root,), repeat),
+    }
+    times["notebook bytes"] = path.stat().st_size
+
+    return times
+
+
+def print_results(results, baseline = None):
+    """Print the class timings as a table, with the ratio to the baseline's
+    timings if there is one.
+    """
+    table = pd.DataFrame(results["classes"])
+    table.columns = ["n={}".format(c) for c in table.columns]
+    print("Subcommand times (seconds):")
+    print(table.round(3).to_string())
+
+    print("\nStartup import times (ms):")
+    for command, result in results["startup"].items():
+        print("  {:<16} {:>7.1f}".format(command, result["seconds"] * 1000))
+
+    if baseline is None:
+        return
+
+    old = pd.DataFrame(baseline["classes"])
+    old.columns = ["n={}".format(c) for c in old.columns]
+    ratio = (table / old).dropna(how = "all").dropna(axis = 1, how = "all")
+    print("\nRatio to baseline (below 1 is faster):")
+    print(ratio.round(2).to_string())
+
+    new_nb = results["notebook"]
+    old_nb = baseline.get("notebook", {})
+    print("\nNotebook function ratio to baseline (median):")
+    for name, t in new_nb.items():
+        if isinstance(t, dict) and isinstance(old_nb.get(name), dict):
+            print("  {:<24} {:.2f}".format(name,
+                t["median"] / old_nb[name]["median"]))
+
+
+def main():
+    ap = argparse.ArgumentParser(description = "Benchmark the grading tools "
+            "on synthetic classes.")
+    ap.add_argument("--sizes", type = int, nargs = "+", default = [10, 50],
+            help = "numbers of students in each synthetic class")
+    ap.add_argument("--cells", type = int, default = 20,
+            help = "number of exercises in each notebook")
+    ap.add_argument("--output-size", dest = "output_size", type = int,
+            default = 1000, help = "characters of output per code cell")
+    ap.add_argument("--image-every", dest = "image_every", type = int,
+            default = 5, help = "add an image output every Nth code cell "
+            "(0 for none)")
+    ap.add_argument("-j", "--jobs", type = int, default = 1,
+            help = "value of '--jobs' for the subcommands")
+    ap.add_argument("--repeat", type = int, default = 5,
+            help = "number of times to call each notebook function")
+    ap.add_argument("-o", "--output", default = "bench.json",
+            help = "path to output JSON file")
+    ap.add_argument("--baseline", help = "path to JSON file from an "
+            "earlier run to compare with")
+    ap.add_argument("--work", help = "directory for the synthetic classes "
+            "(default: a temporary directory, removed afterwards)")
+    args = ap.parse_args()
+
+    work = Path(args.work or tempfile.mkdtemp(prefix = "ucdbench-"))
+    work.mkdir(parents = True, exist_ok = True)
+
+    # Commits need a signature, so don't depend on the user's git config.
+    (work / ".gitconfig").write_text(
+            "[user]\n\tname = Bench\n\temail = bench@example.com\n")
+    pygit2.settings.search_path[pygit2.GIT_CONFIG_LEVEL_GLOBAL] = str(work)
+
+    results = {
+        "created": datetime.now().isoformat(timespec = "seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "versions": {"pygit2": pygit2.__version__,
+            "nbformat": nb.__version__, "pandas": pd.__version__},
+        "params": {"cells": args.cells, "output_size": args.output_size,
+            "image_every": args.image_every, "jobs": args.jobs,
+            "repeat": args.repeat},
+        "classes": {},
+    }
+
+    # Subcommands write files such as canvas_update.csv to the working
+    # directory.
+    cwd = os.getcwd()
+    output = Path(args.output).resolve()
+    try:
+        os.chdir(str(work))
+        for size in args.sizes:
+            print("Timing a class of {} students...".format(size))
+            root = work / "class-{}".format(size)
+            results["classes"][size] = bench_class(root, size, args)
+
+        print("Timing notebook functions...")
+        results["notebook"] = bench_notebook(work / "notebook", args)
+
+        print("Timing startup...")
+        results["startup"] = startup.measure(startup.make_repos(
+                work / "startup"))
+    finally:
+        os.chdir(cwd)
+        if not args.work:
+            shutil.rmtree(str(work), ignore_errors = True)
+
+    with open(output, "wt") as f:
+        json.dump(results, f, indent = 1)
+    print("Wrote '{}'.\n".format(output))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            baseline = json.load(f)
+        # JSON keys are strings, so match the baseline's class sizes.
+        results = json.loads(json.dumps(results))
+
+    print_results(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""GitHub Fetch Benchmark
+
+This script times fetching a file from every repo in an org with the client
+in github/ghapi.py, against a stand-in GitHub server with a fixed latency
+per request. It runs the fetch at several concurrency levels to show the
+speedup, once more with a small rate limit to check that no request is
+rejected, once without rate limit headers to check that the fetch still runs
+concurrently, and twice with a response cache to show how much a repeat fetch
+saves. Finally it fetches with the batched GraphQL backend, and downloads
+each repo's archive, to compare the number of requests. To use it, run
+
+    python bench/fetch.py --repos 64 --jobs 1 2 4 8 16 -o fetch.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from github_server import FakeGitHub
+
+# Make the github/ scripts importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "github"))
+import ghapi
+import ghcache
+import ghgraphql
+
+
+def fetch_all(fake, url, jobs, cache = None, backend = "rest"):
+    """Fetch the homework file from every repo on the server, with the REST
+    or GraphQL backend.
+
+    Returns the time taken in seconds, the number of files fetched, and the
+    number of requests the server got.
+    """
+    before = fake.requests
+    start = time.perf_counter()
+
+    client = ghapi.Client(api_url = url, jobs = jobs, cache = cache)
+    if backend == "graphql":
+        results = ghgraphql.fetch_files(client, fake.org, "", fake.file_name)
+    else:
+        repos = ghapi.org_repos(client, fake.org)
+        results = ghapi.fetch_files(client, repos, fake.file_name,
+            jobs = jobs)
+
+    fetched = 0
+    for result in results:
+        if result.content is not None:
+            fetched += 1
+
+    return time.perf_counter() - start, fetched, fake.requests - before
+
+
+def main():
+    ap = argparse.ArgumentParser(description = "Benchmark the concurrent "
+            "GitHub fetcher against a stand-in server.")
+    ap.add_argument("--repos", type = int, default = 64,
+            help = "number of repos in the org")
+    ap.add_argument("--jobs", type = int, nargs = "+",
+            default = [1, 2, 4, 8, 16], help = "concurrency levels to time")
+    ap.add_argument("--latency", type = float, default = 0.02,
+            help = "seconds of latency per request")
+    ap.add_argument("--rate-limit", dest = "rate_limit", type = int,
+            default = 40, help = "requests per window for the rate limit run")
+    ap.add_argument("--window", type = int, default = 2,
+            help = "seconds per rate limit window for the rate limit run")
+    ap.add_argument("-o", "--output", default = "fetch.json",
+            help = "path to output JSON file")
+    args = ap.parse_args()
+
+    results = {"repos": args.repos, "latency": args.latency, "jobs": {}}
+
+    fake = FakeGitHub(repos = args.repos, latency = args.latency)
+    url = fake.start()
+    try:
+        print("{:>5} {:>9} {:>8} {:>8} {:>8}".format("Jobs", "Time (s)",
+            "Speedup", "Files", "Requests"))
+        base = None
+        for jobs in args.jobs:
+            seconds, fetched, requests = fetch_all(fake, url, jobs)
+            # Speedup is relative to the first concurrency level.
+            base = base or seconds
+            speedup = base / seconds
+            results["jobs"][jobs] = {"seconds": seconds, "files": fetched,
+                "requests": requests, "speedup": speedup}
+            print("{:>5} {:>9.3f} {:>8.2f} {:>8} {:>8}".format(jobs, seconds,
+                speedup, fetched, requests))
+    finally:
+        fake.stop()
+
+    # Run again with a rate limit that the fetch must wait for.
+    fake = FakeGitHub(repos = args.repos, latency = args.latency,
+            rate_limit = args.rate_limit, window = args.window)
+    url = fake.start()
+    try:
+        jobs = max(args.jobs)
+        seconds, fetched, requests = fetch_all(fake, url, jobs)
+    finally:
+        fake.stop()
+
+    results["rate_limit"] = {"limit": args.rate_limit,
+        "window": args.window, "jobs": jobs, "seconds": seconds,
+        "files": fetched, "requests": requests,
+        "rejected": fake.rate_limited}
+    print("\nWith a limit of {} requests per {}s: {} files in {:.1f}s, {} "
+        "rejected".format(args.rate_limit, args.window, fetched, seconds,
+            fake.rate_limited))
+
+    # Run again without rate limit headers, as GitHub Enterprise sends when
+    # rate limiting is off. The fetch shouldn't fall back to one job.
+    fake = FakeGitHub(repos = args.repos, latency = args.latency,
+            rate_headers = False)
+    url = fake.start()
+    try:
+        jobs = max(args.jobs)
+        seconds, fetched, requests = fetch_all(fake, url, jobs)
+    finally:
+        fake.stop()
+
+    limited = results["jobs"][jobs]["seconds"]
+    results["no_rate_headers"] = {"jobs": jobs, "seconds": seconds,
+        "files": fetched, "requests": requests}
+    print("Without rate limit headers at {} jobs: {} files in {:.3f}s "
+        "({:.3f}s with headers)".format(jobs, fetched, seconds, limited))
+
+    # Fetch twice with a cache. The second fetch only gets 304 responses,
+    # which don't count against the rate limit.
+    fake = FakeGitHub(repos = args.repos, latency = args.latency)
+    url = fake.start()
+    cache_dir = tempfile.mkdtemp(prefix = "ghcache-")
+    results["cache"] = {}
+    try:
+        jobs = max(args.jobs)
+        for run in ("cold", "warm"):
+            cache = ghcache.HTTPCache(cache_dir)
+            before = fake.not_modified
+            seconds, fetched, requests = fetch_all(fake, url, jobs, cache)
+            not_modified = fake.not_modified - before
+            results["cache"][run] = {"seconds": seconds, "files": fetched,
+                "requests": requests, "not_modified": not_modified,
+                "rate_limit_used": requests - not_modified,
+                "hits": cache.hits}
+    finally:
+        fake.stop()
+        shutil.rmtree(cache_dir, ignore_errors = True)
+
+    print("\nWith a cache, at {} jobs:".format(jobs))
+    print("{:>5} {:>9} {:>8} {:>8} {:>8} {:>10}".format("Run", "Time (s)",
+        "Files", "Requests", "304s", "Rate used"))
+    for run, r in results["cache"].items():
+        print("{:>5} {:>9.3f} {:>8} {:>8} {:>8} {:>10}".format(run,
+            r["seconds"], r["files"], r["requests"], r["not_modified"],
+            r["rate_limit_used"]))
+
+    fake = FakeGitHub(repos = args.repos, latency = args.latency)
+    url = fake.start()
+    try:
+        seconds, fetched, requests = fetch_all(fake, url, 1,
+            backend = "graphql")
+    finally:
+        fake.stop()
+
+    results["graphql"] = {"seconds": seconds, "files": fetched,
+        "requests": requests}
+    rest = results["cache"]["cold"]["requests"]
+    print("\nWith GraphQL: {} files in {:.3f}s, {} requests ({} with "
+        "REST)".format(fetched, seconds, requests, rest))
+
+    # Download archives, extracting the homework file and the README. This
+    # gets two files per repo, which would take two runs of fetch.
+    fake = FakeGitHub(repos = args.repos, latency = args.latency)
+    url = fake.start()
+    out_dir = tempfile.mkdtemp(prefix = "ghfetch-")
+    try:
+        jobs = max(args.jobs)
+        client = ghapi.Client(api_url = url, jobs = jobs)
+        start = time.perf_counter()
+        repos = ghapi.org_repos(client, fake.org)
+        extracted = sum(len(r.paths) for r in ghapi.fetch_archives(client,
+            repos, out_dir, [fake.file_name, "*.md"], jobs))
+        seconds = time.perf_counter() - start
+    finally:
+        fake.stop()
+        shutil.rmtree(out_dir, ignore_errors = True)
+
+    # Each archive download is a redirect and a download; only the first
+    # counts against the rate limit.
+    requests = fake.requests
+    results["archive"] = {"jobs": jobs, "seconds": seconds,
+        "files": extracted, "requests": requests,
+        "rate_limit_used": fake.rate_limit - fake.remaining}
+    print("With archives at {} jobs: {} files in {:.3f}s, {} requests, {} "
+        "against the rate limit ({} with REST fetch)".format(jobs, extracted,
+            seconds, requests, fake.rate_limit - fake.remaining, 2 * rest))
+
+    with open(args.output, "wt") as f:
+        json.dump(results, f, indent = 1)
+    print("Wrote '{}'.".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
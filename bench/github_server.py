@@ -0,0 +1,338 @@
+"""This module contains a stand-in GitHub API server for benchmarking the
+scripts in github/ without a network connection or token.
+
+The server has one org with a number of repos, each with one student
+collaborator (plus an admin) and a homework file. It adds a fixed latency to
+every request, and enforces a rate limit with the same headers and 403
+responses as GitHub. Like GitHub, it sends an ETag with each response and
+answers matching conditional requests with a 304 that doesn't count against
+the rate limit.
+
+It also answers the GraphQL queries in github/ghgraphql.py (but not other
+GraphQL queries), counting each query as one point of a separate 'graphql'
+budget, as GitHub does. Tarball requests
+redirect to a download URL, as GitHub's do, and the download doesn't count
+against the rate limit.
+"""
+import base64
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import tarfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeGitHub:
+    """The state of the stand-in server, and counts of the requests it got.
+    """
+    def __init__(self, org = "UCDSTA141B", repos = 50, latency = 0.02,
+            rate_limit = 5000, window = 3600, file_name = "hw1.ipynb",
+            file_size = 20000, admins = ("nick-ulle",), rate_headers = True):
+        self.org = org
+        self.latency = latency
+        self.rate_limit = rate_limit
+        # Without rate limit headers, the server acts like GitHub Enterprise
+        # with rate limiting turned off: nothing is counted or rejected.
+        self.rate_headers = rate_headers
+        self.window = window
+        self.file_name = file_name
+
+        self.repos = {}
+        for i in range(repos):
+            name = "hw1-user{:04}".format(i)
+            content = json.dumps({"cells": [], "student": i}).encode()
+            content += b" " * max(file_size - len(content), 0)
+            self.repos[name] = {
+                "users": ["user{:04}".format(i)] + list(admins),
+                "files": {file_name: content,
+                    "README.md": "# Homework {}\n".format(i).encode()},
+                "head": hashlib.sha1(content).hexdigest(),
+            }
+        self.members = ["user{:04}".format(i) for i in range(repos)]
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.rate_limited = 0
+        # The remaining count and reset time for each resource.
+        self.budgets = {}
+
+    @property
+    def remaining(self):
+        """The remaining count of the 'core' (REST) budget."""
+        return self.budgets.get("core", [self.rate_limit])[0]
+
+    def take(self, count = True, resource = "core"):
+        """Count a request against the rate limit for a resource, unless
+        count is False.
+
+        Returns the headers that describe the rate limit, and whether the
+        request is allowed.
+        """
+        with self.lock:
+            self.requests += 1
+            if not self.rate_headers:
+                return {}, True
+            now = time.time()
+            budget = self.budgets.get(resource)
+            if budget is None or now >= budget[1]:
+                budget = [self.rate_limit, int(now) + self.window]
+                self.budgets[resource] = budget
+
+            allowed = True
+            if count:
+                allowed = budget[0] > 0
+                if allowed:
+                    budget[0] -= 1
+                else:
+                    self.rate_limited += 1
+
+            limits = {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(budget[0]),
+                "X-RateLimit-Reset": str(budget[1]),
+                "X-RateLimit-Resource": resource,
+            }
+            return limits, allowed
+
+    def repo_json(self, name, base):
+        return {
+            "name": name,
+            "full_name": "{}/{}".format(self.org, name),
+            "html_url": "https://github.com/{}/{}".format(self.org, name),
+            "url": "{}/repos/{}/{}".format(base, self.org, name),
+        }
+
+    def tarball(self, name):
+        """Make a gzipped tarball of a repo, laid out as GitHub's are."""
+        repo = self.repos[name]
+        prefix = "{}-{}-{}".format(self.org, name, repo["head"][:7])
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj = data, mode = "w:gz") as tar:
+            for path, content in repo["files"].items():
+                info = tarfile.TarInfo("{}/{}".format(prefix, path))
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+        return data.getvalue()
+
+    def start(self, port = 0):
+        """Start the server in a thread, and return its URL.
+        """
+        state = self
+
+        class Handler(FakeHandler):
+            fake = state
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target = self.server.serve_forever,
+                daemon = True)
+        thread.start()
+
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, headers = None, content_type =
+            "application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.fake.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        base = "http://{}".format(self.headers["Host"])
+
+        status, body, headers = self.route(parts, query, base)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+
+        not_modified = False
+        if status == 200:
+            headers["ETag"] = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            not_modified = self.headers.get("If-None-Match") == headers["ETag"]
+
+        if not_modified:
+            with self.fake.lock:
+                self.fake.not_modified += 1
+
+        download = parts[0] == "_codeload"
+        limits, allowed = self.fake.take(
+            count = not (not_modified or download))
+        if not allowed:
+            self.send(403, {"message": "API rate limit exceeded"}, limits)
+            return
+
+        headers.update(limits)
+        if not_modified:
+            status, body = 304, b""
+        content_type = headers.pop("Content-Type", "application/json")
+        self.send(status, body, headers, content_type)
+
+    def do_POST(self):
+        time.sleep(self.fake.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+
+        limits, allowed = self.fake.take(resource = "graphql")
+        if not allowed:
+            self.send(403, {"message": "API rate limit exceeded"}, limits)
+            return
+
+        if urlparse(self.path).path != "/graphql":
+            self.send(404, {"message": "Not Found"}, limits)
+            return
+
+        self.send(200, self.graphql(request["query"],
+            request.get("variables") or {}), limits)
+
+    def graphql(self, text, variables):
+        fake = self.fake
+        if "organization(login: $org)" in text:
+            names = list(fake.repos)
+            start = int(variables.get("cursor") or 0)
+            end = min(start + 100, len(names))
+            return {"data": {"organization": {"repositories": {
+                "pageInfo": {"hasNextPage": end < len(names),
+                    "endCursor": str(end)},
+                "nodes": [{"name": n} for n in names[start:end]],
+            }}}}
+
+        if "repository(owner: $owner, name: $n0)" in text:
+            data = {}
+            i = 0
+            while "n{}".format(i) in variables:
+                data["r{}".format(i)] = self.repo_node(
+                    variables["n{}".format(i)], variables)
+                i += 1
+            return {"data": data}
+
+        return {"data": None, "errors": [{"message": "Unsupported query"}]}
+
+    def repo_node(self, name, variables):
+        fake = self.fake
+        repo = fake.repos.get(name)
+        if repo is None:
+            return None
+
+        path = variables["expression"].split(":", 1)[1]
+        content = repo["files"].get(path)
+        node = {
+            "name": name,
+            "nameWithOwner": "{}/{}".format(fake.org, name),
+            "url": "https://github.com/{}/{}".format(fake.org, name),
+            "owner": {"login": fake.org},
+            "defaultBranchRef": None,
+            "file": None,
+        }
+        if repo["head"] is not None:
+            node["defaultBranchRef"] = {"target": {"oid": repo["head"]}}
+        if content is not None:
+            node["file"] = {"text": content.decode("utf-8"),
+                "isBinary": False, "isTruncated": False}
+        if variables.get("users"):
+            node["collaborators"] = {"pageInfo": {"hasNextPage": False},
+                "nodes": [{"login": u} for u in repo["users"]]}
+
+        return node
+
+    def route(self, parts, query, base):
+        fake = self.fake
+        not_found = (404, {"message": "Not Found"}, {})
+
+        if parts[0] == "_codeload" and len(parts) == 3:
+            if parts[1] != fake.org or parts[2] not in fake.repos:
+                return not_found
+            return (200, fake.tarball(parts[2]),
+                {"Content-Type": "application/x-gzip"})
+
+        if parts[:2] == ["orgs", fake.org] and len(parts) == 3:
+            if parts[2] == "repos":
+                items = [fake.repo_json(n, base) for n in fake.repos]
+            elif parts[2] == "members":
+                items = [{"login": u} for u in fake.members]
+            elif parts[2] == "outside_collaborators":
+                items = []
+            else:
+                return not_found
+            return self.paginate(items, query, base)
+
+        if parts[:2] != ["repos", fake.org] or len(parts) < 4:
+            return not_found
+        repo = fake.repos.get(parts[2])
+        if repo is None:
+            return not_found
+
+        if parts[3] == "collaborators":
+            items = [{"login": u} for u in repo["users"]]
+            return self.paginate(items, query, base)
+
+        if parts[3] == "tarball":
+            if repo["head"] is None:
+                return not_found
+            location = "{}/_codeload/{}/{}".format(base, fake.org, parts[2])
+            return (302, b"", {"Location": location})
+
+        if parts[3] == "commits" and repo["head"] is None:
+            return (409, {"message": "Git Repository is empty."}, {})
+
+        if parts[3] == "commits" and len(parts) == 4:
+            return self.paginate([{"sha": repo["head"]}], query, base)
+
+        if parts[3] == "commits" and len(parts) == 5:
+            if "sha" in self.headers.get("Accept", ""):
+                return (200, repo["head"].encode(),
+                    {"Content-Type": "application/vnd.github.sha"})
+            return (200, {"sha": repo["head"]}, {})
+
+        if parts[3] == "contents":
+            path = "/".join(parts[4:])
+            content = repo["files"].get(path)
+            if content is None:
+                return not_found
+            if "raw" in self.headers.get("Accept", ""):
+                return (200, content,
+                    {"Content-Type": "application/vnd.github.raw"})
+            return (200, {"name": path, "path": path, "encoding": "base64",
+                "content": base64.b64encode(content).decode("ascii")}, {})
+
+        return not_found
+
+    def paginate(self, items, query, base):
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        start = (page - 1) * per_page
+
+        headers = {}
+        if start + per_page < len(items):
+            path = urlparse(self.path).path
+            headers["Link"] = '<{}{}?page={}&per_page={}>; rel="next"'.format(
+                    base, path, page + 1, per_page)
+
+        return (200, items[start:(start + per_page)], headers)
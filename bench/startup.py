@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Startup Time Check
+
+This script checks that ucdtool.py starts quickly: it runs the tool with
+'-X importtime' and fails if the '--help' commands' imports take longer than
+a budget, or if a command imports one of pandas, pygit2, nbformat, or pytz
+that it doesn't need. Besides the '--help' commands, it runs 'prepare' on a
+class of one student, which needs all of them but pandas. To use it, run
+
+    python bench/startup.py --budget 50
+
+The exit status is 1 if any command is over budget or fails.
+"""
+import argparse
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+
+import pygit2 as git
+
+import synthetic
+
+TOOL = Path(__file__).resolve().parent.parent / "ucdtool.py"
+
+HEAVY_MODULES = ["pandas", "pygit2", "nbformat", "pytz"]
+# Commands to check, with the heavy modules each one may import. The
+# '{repos}' argument is replaced with a directory of repos. Only commands
+# that may import none of them have to be under the budget.
+COMMANDS = [
+    (["--help"], []),
+    (["clone", "--help"], []),
+    (["prepare", "--help"], []),
+    (["grade", "--help"], []),
+    (["push", "--help"], []),
+    (["prepare", "{repos}", "02.12 16:00"], ["pygit2", "nbformat", "pytz"]),
+]
+
+# Imported by the interpreter before the tool runs, and so not the tool's
+# fault. The site module can be slow because of .pth files in the
+# environment.
+IGNORE_MODULES = ["site", "encodings", "_frozen_importlib_external"]
+
+
+def make_repos(root):
+    """Clone a synthetic class of one student into root, and return the path
+    to the repos directory.
+    """
+    origins, _, _ = synthetic.make_class(root, 1, cells = 2)
+    repos = Path(root) / "repos"
+    for origin in origins.iterdir():
+        git.clone_repository(origin.as_uri(),
+                str(repos / origin.stem))
+
+    return repos
+
+
+def import_times(argv):
+    """Run ucdtool.py with '-X importtime'.
+
+    Returns a dict of the cumulative import time in seconds of each
+    top-level import, a set of the names of all imported modules, and
+    whether the command succeeded.
+    """
+    cmd = [sys.executable, "-X", "importtime", str(TOOL)] + argv
+    proc = subprocess.run(cmd, stdout = subprocess.DEVNULL,
+            stderr = subprocess.PIPE, universal_newlines = True,
+            cwd = str(TOOL.parent))
+
+    times = {}
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # The header line.
+            continue
+
+        # Nested imports are indented, and are counted in their parent's
+        # cumulative time.
+        name = fields[2][1:].rstrip()
+        modules.add(name.strip())
+        if name.startswith(" ") or name in IGNORE_MODULES:
+            continue
+        times[name] = cumulative / 1e6
+
+    return times, modules, proc.returncode == 0
+
+
+def measure(repos, repeat = 3):
+    """Measure the import time of each command in COMMANDS, running them on
+    the repos directory.
+
+    Returns a dict mapping each command to its best total import time in
+    seconds over repeat runs, the heavy modules it imported that it
+    shouldn't have, whether it has to be under the budget, and whether every
+    run succeeded.
+    """
+    results = {}
+    for argv, allowed in COMMANDS:
+        argv = [a.format(repos = repos) for a in argv]
+        best = None
+        ok = True
+        for _ in range(repeat):
+            times, modules, success = import_times(argv)
+            ok = ok and success
+            total = sum(times.values())
+            if best is None or total < best[0]:
+                best = (total, modules)
+
+        total, modules = best
+        heavy = [m for m in HEAVY_MODULES
+                if m in modules and m not in allowed]
+        name = " ".join(argv[:1] if allowed else argv)
+        results[name] = {"seconds": total, "heavy": heavy,
+                "budgeted": not allowed, "ok": ok}
+
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description = "Check the startup time of "
+            "ucdtool.py.")
+    ap.add_argument("--budget", type = float, default = 50,
+            help = "most milliseconds allowed for imports")
+    ap.add_argument("--repeat", type = int, default = 3,
+            help = "number of runs per command (the best is used)")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix = "startup-") as root:
+        results = measure(make_repos(root), args.repeat)
+
+    ok = True
+    for command, result in results.items():
+        ms = result["seconds"] * 1000
+        problems = []
+        if not result["ok"]:
+            problems.append("failed")
+        if result["budgeted"] and ms > args.budget:
+            problems.append("over budget")
+        if result["heavy"]:
+            problems.append("imports " + ", ".join(result["heavy"]))
+
+        ok = ok and not problems
+        print("{:<16} {:>7.1f} ms  {}".format(command, ms,
+            "; ".join(problems) or "ok"))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""This module generates a synthetic class for benchmarking: one bare "origin"
+repo per student with a homework notebook in it, a roster, and a Canvas
+gradebook.
+
+The layout matches what ucdtool.py expects, so the origins directory can be
+used as the base URL and the roster as the users file:
+
+    ROOT/
+        origins/NAME-USER.git
+        users.csv
+        canvas.csv
+"""
+import base64
+import json
+from pathlib import Path
+import random
+
+import pandas as pd
+import pygit2 as git
+
+# Commit time for every synthetic commit (UTC).
+COMMIT_TIME = 1550000000
+SIGNATURE = git.Signature("Synthetic Student", "student@example.com",
+        COMMIT_TIME, 0)
+
+
+def make_notebook(cells = 20, output_size = 1000, image_every = 5,
+        seed = 0):
+    """Make a homework notebook as a JSON string.
+
+    Each exercise is a markdown cell followed by a code cell whose output is
+    output_size characters of text. Every image_every-th code cell also has
+    a PNG-sized blob of base64 output of the same size (0 for none).
+    """
+    rand = random.Random(seed)
+    out = []
+    for i in range(cells):
+        out.append({
+            "cell_type": "markdown",
+            "id": "ex{}".format(i),
+            "metadata": {"tags": ["exercise"]},
+            "source": "__Exercise 1.{} (10 points).__ Answer the question."
+                .format(i + 1),
+        })
+
+        outputs = [{
+            "name": "stdout",
+            "output_type": "stream",
+            "text": "".join(rand.choices("abcdef \n", k = output_size)),
+        }]
+        if image_every and i % image_every == 0:
+            data = rand.getrandbits(8 * output_size).to_bytes(output_size,
+                    "little")
+            outputs.append({
+                "data": {
+                    "image/png": base64.b64encode(data).decode("ascii"),
+                    "text/plain": "<Figure>",
+                },
+                "metadata": {},
+                "output_type": "display_data",
+            })
+
+        out.append({
+            "cell_type": "code",
+            "execution_count": i + 1,
+            "id": "code{}".format(i),
+            "metadata": {},
+            "outputs": outputs,
+            "source": "answer_{} = compute({})".format(i, i),
+        })
+
+    notebook = {
+        "cells": out,
+        "metadata": {
+            "kernelspec": {"display_name": "Python 3", "language": "python",
+                "name": "python3"},
+            "language_info": {"name": "python"},
+        },
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+    return json.dumps(notebook, indent = 1, sort_keys = True) + "\n"
+
+
+def make_origin(path, files):
+    """Create a bare repo with one commit on master that contains the files,
+    given as a dict of names and contents.
+    """
+    repo = git.init_repository(str(path), bare = True)
+
+    builder = repo.TreeBuilder()
+    for name, content in files.items():
+        blob = repo.create_blob(content.encode("utf-8"))
+        builder.insert(name, blob, git.GIT_FILEMODE_BLOB)
+
+    repo.create_commit("refs/heads/master", SIGNATURE, SIGNATURE,
+            "Submit homework", builder.write(), [])
+
+    return repo
+
+
+def make_class(root, students, name = "hw1", cells = 20, output_size = 1000,
+        image_every = 5):
+    """Generate a synthetic class in the root directory.
+
+    Each student gets a notebook with the same cells but different output.
+    Returns the paths to the origins directory, the roster, and the Canvas
+    gradebook.
+    """
+    root = Path(root)
+    origins = root / "origins"
+    origins.mkdir(parents = True, exist_ok = True)
+
+    rows = []
+    for i in range(students):
+        email = "student{:04}@example.com".format(i)
+        user = "user{:04}".format(i)
+        sis_id = "9{:08}".format(i)
+        rows.append((email, user, sis_id))
+
+        notebook = make_notebook(cells, output_size, image_every, seed = i)
+        files = {"{}.ipynb".format(name): notebook,
+                "README.md": "# Homework\n"}
+        make_origin(origins / "{}-{}.git".format(name, user), files)
+
+    # Roster linking emails, GitHub usernames, and SIS IDs.
+    users = pd.DataFrame(rows, columns = ["email", "github", "id"])
+    users_path = root / "users.csv"
+    users.to_csv(users_path, index = False)
+
+    # Canvas gradebook, with the 'Points Possible' row Canvas exports.
+    canvas = pd.DataFrame({
+        "Student": ["Points Possible"] + ["Student {}".format(i)
+            for i in range(students)],
+        "ID": [""] + [str(1000 + i) for i in range(students)],
+        "SIS User ID": [""] + [r[2] for r in rows],
+        "SIS Login ID": [""] + [r[0].partition("@")[0] for r in rows],
+        "Section": [""] + ["A0{}".format(1 + i % 3) for i in range(students)],
+        "{} (12345)".format(name): [100] + [None] * students,
+    })
+    canvas_path = root / "canvas.csv"
+    canvas.to_csv(canvas_path, index = False)
+
+    return origins, users_path, canvas_path
+
+
+def fill_rubric(path, seed = 0, name = "feedback.ipynb"):
+    """Fill in the rubric grade cell of a feedback notebook with random
+    scores, as a grader would.
+    """
+    path = Path(path) / name
+    with open(path, "rt") as f:
+        notebook = json.load(f)
+
+    rand = random.Random(seed)
+    for cell in notebook["cells"]:
+        if "grade" in cell["metadata"].get("tags", []):
+            source = cell["source"]
+            if isinstance(source, list):
+                source = "".join(source)
+            lines = source.split("\n")
+            for i, line in enumerate(lines):
+                if line[:1] in "RFC" and line.endswith("|"):
+                    lines[i] = "{} {}".format(line, rand.randint(0, 3))
+            cell["source"] = "\n".join(lines)
+            break
+
+    with open(path, "wt") as f:
+        json.dump(notebook, f, indent = 1, sort_keys = True)
+        f.write("\n")
@@ -12,7 +12,17 @@ users = "users.csv"
 # ------------------------------------------------------------
 # Time settings. DO NOT EDIT unless you know what you're doing.
 from datetime import datetime
-import pytz
 
 year = datetime.now().year
-tzinfo = pytz.timezone("US/Pacific")
+tz_name = "US/Pacific"
+
+
+def __getattr__(name):
+    # pytz is slow to import, so only import it when tzinfo is first used.
+    if name == "tzinfo":
+        import pytz
+        globals()["tzinfo"] = pytz.timezone(tz_name)
+        return globals()["tzinfo"]
+
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__,
+        name))
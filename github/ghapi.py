@@ -0,0 +1,420 @@
+"""This module contains a small GitHub REST client for fetching files from many
+repos at once.
+
+All requests share one connection pool, so they can be made from a thread
+pool. The client reads the 'X-RateLimit-Remaining' and 'X-RateLimit-Reset'
+headers on every response and holds back new requests when the remaining
+budget runs low, so a big fetch waits for the reset instead of getting 403
+errors.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fnmatch
+from pathlib import Path, PurePosixPath
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+API_URL = "https://api.github.com"
+
+# Submission statuses from submission_status().
+EMPTY = "empty"
+UNCHANGED = "unchanged"
+CHANGED = "changed"
+
+# What fetch_file() found in a repo. The content is None if there's an error.
+# The head is the SHA of the default branch's head commit, if it's known.
+RepoFile = namedtuple("RepoFile", ["name", "url", "users", "content",
+    "error", "head"], defaults = (None,))
+
+# What fetch_archive() extracted from a repo.
+RepoArchive = namedtuple("RepoArchive", ["name", "url", "paths", "error"])
+
+# Bytes to read at a time when downloading archives.
+CHUNK_SIZE = 2**16
+
+
+class GitHubError(Exception):
+    """An error response from the GitHub API."""
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class RateLimit:
+    """Schedule requests so they stay within GitHub's rate limit.
+
+    Until a response says how many requests remain, only one request is made
+    at a time. After that, requests go ahead while the remaining budget (less
+    requests in flight) is above the reserve, and otherwise wait for the
+    reset time. If that first response has no rate limit headers (for
+    instance, GitHub Enterprise with rate limiting turned off), requests
+    aren't held back until a response has them again.
+
+    GitHub keeps a separate budget for each resource ('core' for REST,
+    'graphql' for GraphQL), so each gets its own RateLimit. Headers for
+    another resource are ignored.
+    """
+    def __init__(self, reserve = 10, resource = "core"):
+        self.reserve = reserve
+        self.resource = resource
+        self.remaining = None
+        self.unlimited = False
+        self.reset = 0
+        self.in_flight = 0
+        self.announced = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                if self.unlimited:
+                    break
+                if self.remaining is None:
+                    if self.in_flight == 0:
+                        break
+                    self.cond.wait()
+                elif self.remaining - self.in_flight > self.reserve:
+                    break
+                else:
+                    wait = self.reset - time.time()
+                    if wait <= 0:
+                        # A new window started, so check the budget again.
+                        self.remaining = None
+                        continue
+                    if self.announced != self.reset:
+                        self.announced = self.reset
+                        print(f"Waiting {wait:.0f}s for the GitHub rate "
+                            "limit...")
+                    self.cond.wait(wait + 1)
+
+            self.in_flight += 1
+
+    def release(self, headers = None):
+        with self.cond:
+            self.in_flight -= 1
+            if headers is not None:
+                self.update(headers)
+            self.cond.notify_all()
+
+    def update(self, headers):
+        if "X-RateLimit-Remaining" not in headers:
+            # Only a first response can show that there's no rate limit.
+            # Later ones might just be errors from a proxy.
+            if self.remaining is None:
+                self.unlimited = True
+            return
+        if headers.get("X-RateLimit-Resource", self.resource) != self.resource:
+            return
+
+        self.unlimited = False
+
+        remaining = int(headers["X-RateLimit-Remaining"])
+        reset = int(headers.get("X-RateLimit-Reset", 0))
+
+        # Responses can arrive out of order, so within a window only trust
+        # the lowest count.
+        if self.remaining is None or reset > self.reset:
+            self.remaining = remaining
+            self.reset = reset
+        elif reset == self.reset:
+            self.remaining = min(self.remaining, remaining)
+
+    def wait_time(self, response):
+        """Return how long to wait before retrying a rate-limited response,
+        or None if the response wasn't rate-limited.
+        """
+        if response.status_code not in (403, 429):
+            return None
+
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"])
+
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            return max(self.reset - time.time(), 0) + 1
+
+        return None
+
+
+class Client:
+    """A GitHub REST API client that can be shared by threads."""
+    def __init__(self, token = None, api_url = API_URL, jobs = 8,
+            reserve = 10, retries = 3, cache = None):
+        self.api_url = api_url.rstrip("/")
+        self.retries = retries
+        self.limits = {r: RateLimit(reserve, r) for r in ("core", "graphql")}
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1,
+            pool_maxsize = max(jobs, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.session.headers["Accept"] = "application/vnd.github+json"
+        if token:
+            self.session.headers["Authorization"] = f"token {token}"
+
+    def request(self, method, path, **kwargs):
+        """Make a request, waiting for the rate limit if necessary.
+
+        The path can be relative to the API URL or a full URL. If the client
+        has a cache, GET requests are made conditional on the cached
+        response, and a 304 response is answered from the cache. Streamed
+        requests aren't cached, since that would read the whole body. Raises
+        GitHubError for error responses.
+        """
+        url = path if "://" in path else self.api_url + path
+
+        key = None
+        if (self.cache is not None and method == "GET"
+                and not kwargs.get("stream")):
+            request = self.session.prepare_request(requests.Request(method,
+                url, params = kwargs.get("params"),
+                headers = kwargs.get("headers")))
+            key = self.cache.key(request)
+            headers = self.cache.conditional_headers(key)
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **headers)
+
+        response = self.send(method, url, **kwargs)
+
+        if key is not None:
+            if response.status_code == 304:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+                # The entry was just evicted, so get the response again.
+                kwargs["headers"].pop("If-None-Match", None)
+                kwargs["headers"].pop("If-Modified-Since", None)
+                response = self.send(method, url, **kwargs)
+            if response.status_code == 200:
+                self.cache.put(key, response)
+
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("message", response.reason)
+            except ValueError:
+                message = response.reason
+            raise GitHubError(response.status_code, message)
+
+        return response
+
+    def send(self, method, url, **kwargs):
+        """Make a request within the rate limit, retrying if it's rejected
+        anyway.
+        """
+        limit = self.rate_limit(url)
+        for attempt in range(self.retries + 1):
+            limit.acquire()
+            headers = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                # Redirects (for instance, to download an archive) end at
+                # another host, so the rate limit is in the first response.
+                headers = (response.history or [response])[0].headers
+            finally:
+                limit.release(headers)
+
+            wait = limit.wait_time(response)
+            if wait is None or attempt == self.retries:
+                break
+            time.sleep(wait)
+
+        return response
+
+    def rate_limit(self, url):
+        """Get the RateLimit for the resource a URL uses."""
+        if urlparse(url).path.endswith("/graphql"):
+            return self.limits["graphql"]
+        return self.limits["core"]
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def paginate(self, path, params = None):
+        """Generate the items of a paginated list, following the 'next'
+        links.
+        """
+        params = dict(params or {}, per_page = 100)
+        response = self.get(path, params = params)
+        while True:
+            yield from response.json()
+
+            next_page = response.links.get("next")
+            if next_page is None:
+                return
+            response = self.get(next_page["url"])
+
+
+def user_logins(client, org):
+    """Get the logins of an org's members and outside collaborators."""
+    members = client.paginate(f"/orgs/{org}/members")
+    outside = client.paginate(f"/orgs/{org}/outside_collaborators")
+    return sorted({u["login"] for u in members} | {u["login"] for u in outside})
+
+
+def org_repos(client, org, search = ""):
+    """Generate the repos in an org whose names contain the search term."""
+    for repo in client.paginate(f"/orgs/{org}/repos"):
+        if search in repo["name"]:
+            yield repo
+
+
+def collaborators(client, repo, ignore = ()):
+    """Get the logins of a repo's collaborators, except those in ignore."""
+    users = client.paginate(f"/repos/{repo['full_name']}/collaborators")
+    return [u["login"] for u in users if u["login"] not in ignore]
+
+
+def head_status(head, template_sha):
+    """Get the submission status for a head commit SHA, which is None if the
+    repo is empty.
+    """
+    if head is None:
+        return EMPTY
+    elif head == template_sha:
+        return UNCHANGED
+    return CHANGED
+
+
+def submission_status(client, repo, template_sha, ref = "HEAD"):
+    """Check whether a repo is empty, unchanged from the template commit, or
+    has new commits.
+
+    This makes one request for the SHA of the ref, rather than listing the
+    commits. Returns the status and the SHA (None if the repo is empty).
+    """
+    try:
+        response = client.get(f"/repos/{repo['full_name']}/commits/{ref}",
+            headers = {"Accept": "application/vnd.github.sha"})
+    except GitHubError as e:
+        # GitHub answers 409 for an empty repo.
+        if e.status == 409:
+            return EMPTY, None
+        raise
+
+    head = response.text.strip()
+    return head_status(head, template_sha), head
+
+
+def file_contents(client, repo, path):
+    """Get the raw contents of a file in a repo's default branch."""
+    response = client.get(f"/repos/{repo['full_name']}/contents/{path}",
+        headers = {"Accept": "application/vnd.github.raw"})
+    return response.content
+
+
+def fetch_file(client, repo, path, ignore = ()):
+    """Find the users of a repo and get a file from it.
+
+    Repos without users are skipped (the file isn't requested). Returns a
+    RepoFile; errors are returned rather than raised, so that this can be
+    used in a thread pool.
+    """
+    name = repo["name"]
+    url = repo["html_url"]
+    users = []
+    content = None
+    try:
+        users = collaborators(client, repo, ignore)
+        if len(users) != 0:
+            content = file_contents(client, repo, path)
+    except GitHubError as e:
+        return RepoFile(name, url, users, None, e)
+
+    return RepoFile(name, url, users, content, None)
+
+
+def fetch_files(client, repos, path, ignore = (), jobs = 8):
+    """Fetch a file from each repo, with up to jobs requests at once.
+
+    Generates a RepoFile for each repo, in the order they finish.
+    """
+    with ThreadPoolExecutor(max_workers = jobs) as pool:
+        futures = [pool.submit(fetch_file, client, repo, path, ignore)
+            for repo in repos]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def extract_matching(tar, dest, patterns):
+    """Extract the files in a repo archive whose paths match any of the glob
+    patterns into dest, and return their paths.
+    """
+    paths = []
+    for member in tar:
+        if not member.isfile():
+            continue
+
+        # Paths start with a directory named after the repo and commit.
+        parts = PurePosixPath(member.name).parts[1:]
+        if len(parts) == 0 or ".." in parts:
+            continue
+        if not any(fnmatch.fnmatch("/".join(parts), p) for p in patterns):
+            continue
+
+        path = dest.joinpath(*parts)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        with tar.extractfile(member) as src, open(path, "wb") as out:
+            shutil.copyfileobj(src, out)
+        paths.append(path)
+
+    return paths
+
+
+def download_archive(client, repo, dest, patterns = ("*",), ref = "HEAD"):
+    """Download a tarball of a repo, and extract the files that match any of
+    the glob patterns into dest.
+
+    The archive is streamed to a temporary file rather than read into
+    memory. Returns the paths of the extracted files.
+    """
+    response = client.get(f"/repos/{repo['full_name']}/tarball/{ref}",
+        stream = True)
+
+    dest = Path(dest)
+    dest.mkdir(parents = True, exist_ok = True)
+    with tempfile.TemporaryFile(dir = dest) as f:
+        with response:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+
+        f.seek(0)
+        with tarfile.open(fileobj = f, mode = "r:gz") as tar:
+            return extract_matching(tar, dest, patterns)
+
+
+def fetch_archive(client, repo, dest, patterns = ("*",)):
+    """Download and extract a repo's archive into a directory named after
+    the repo in dest.
+
+    Returns a RepoArchive; errors are returned rather than raised, so that
+    this can be used in a thread pool.
+    """
+    name = repo["name"]
+    url = repo["html_url"]
+    try:
+        paths = download_archive(client, repo, Path(dest) / name, patterns)
+    except (GitHubError, requests.RequestException, tarfile.TarError) as e:
+        return RepoArchive(name, url, [], e)
+
+    return RepoArchive(name, url, paths, None)
+
+
+def fetch_archives(client, repos, dest, patterns = ("*",), jobs = 8):
+    """Download and extract each repo's archive, with up to jobs downloads at
+    once.
+
+    Generates a RepoArchive for each repo, in the order they finish.
+    """
+    with ThreadPoolExecutor(max_workers = jobs) as pool:
+        futures = [pool.submit(fetch_archive, client, repo, dest, patterns)
+            for repo in repos]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,148 @@
+"""This module contains an on-disk cache for GitHub API responses.
+
+GitHub sends an 'ETag' (and sometimes a 'Last-Modified' time) with each
+response. When a cached response is requested again, the client sends them
+back in 'If-None-Match' and 'If-Modified-Since' headers, and if nothing
+changed GitHub answers with an empty 304 response, which doesn't count
+against the rate limit. The body is then read from the cache.
+
+Each response is stored as two files named after a hash of the request: the
+body, and a small JSON file with the URL and headers. When the cache grows
+past its size limit, the least recently used responses are removed.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CACHE_DIR = ".ghcache"
+MAX_BYTES = 200 * 2**20
+
+# Response headers to keep. Link is needed for pagination.
+KEEP_HEADERS = ["Content-Type", "ETag", "Last-Modified", "Link"]
+
+
+class HTTPCache:
+    """A size-bounded cache of GET responses, shared by threads."""
+    def __init__(self, path = CACHE_DIR, max_bytes = MAX_BYTES):
+        self.path = Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Responses served from the cache, and responses stored.
+        self.hits = 0
+        self.stored = 0
+
+        self.size = sum(p.stat().st_size for p in self.path.iterdir())
+
+    def key(self, request):
+        """Get the cache key for a prepared request.
+
+        The key covers the URL (with query), the media type, and the token,
+        so different users never share entries.
+        """
+        parts = [request.url, request.headers.get("Accept", ""),
+            request.headers.get("Authorization", "")]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def conditional_headers(self, key):
+        """Get the headers that make a request conditional on the cached
+        response, or an empty dict if there's no cached response.
+        """
+        meta = self.read_meta(key)
+        if meta is None:
+            return {}
+
+        headers = {}
+        if "ETag" in meta["headers"]:
+            headers["If-None-Match"] = meta["headers"]["ETag"]
+        if "Last-Modified" in meta["headers"]:
+            headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        return headers
+
+    def read_meta(self, key):
+        try:
+            with open(self.path / (key + ".json"), "rt") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, key):
+        """Build a response from the cache, or return None if the entry is
+        missing.
+        """
+        meta = self.read_meta(key)
+        body_path = self.path / (key + ".body")
+        try:
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        if meta is None:
+            return None
+
+        # Mark the entry as recently used.
+        os.utime(body_path)
+        with self.lock:
+            self.hits += 1
+
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = meta["url"]
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response._content = body
+        return response
+
+    def put(self, key, response):
+        """Store a response, if it has an ETag or Last-Modified time."""
+        headers = {h: response.headers[h] for h in KEEP_HEADERS
+            if h in response.headers}
+        if "ETag" not in headers and "Last-Modified" not in headers:
+            return
+
+        meta = json.dumps({"url": response.url, "headers": headers})
+        added = self.write(key + ".json", meta.encode())
+        added += self.write(key + ".body", response.content)
+
+        with self.lock:
+            self.stored += 1
+            self.size += added
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def write(self, name, data):
+        """Write a file atomically, and return the change in the cache's
+        size.
+        """
+        path = self.path / name
+        old = path.stat().st_size if path.exists() else 0
+
+        # Threads can write the same entry, so each uses its own temp file.
+        tmp = self.path / "{}.{}.tmp".format(name, threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(str(tmp), str(path))
+
+        return len(data) - old
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is under
+        90% of its size limit. Call with the lock held.
+        """
+        bodies = sorted(self.path.glob("*.body"),
+            key = lambda p: p.stat().st_mtime)
+        for body in bodies:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            meta = body.with_suffix(".json")
+            for path in (body, meta):
+                try:
+                    self.size -= path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
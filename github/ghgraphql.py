@@ -0,0 +1,204 @@
+"""This module contains a GraphQL backend for fetching files from many repos
+with few requests.
+
+The REST API needs several requests per repo: one each for the
+collaborators, the head commit, and the file. The GraphQL API can get all of
+these for a batch of repos in one request, so collecting an assignment takes
+about one request per 50 repos, plus one per 100 repos to list the org.
+
+Large or binary files aren't sent in full by the GraphQL API, so those are
+fetched with the REST API instead. The same goes for repos with more
+collaborators than one request returns.
+"""
+import ghapi
+from ghapi import RepoFile, GitHubError
+
+# Repos per batch. Each repo's file is in the response, so large batches of
+# large files can make GitHub time out.
+BATCH_SIZE = 50
+
+# Collaborators to get per repo. Repos with more fall back to REST.
+MAX_USERS = 20
+
+REPO_FIELDS = f"""
+fragment repoFields on Repository {{
+  name
+  nameWithOwner
+  url
+  owner {{ login }}
+  collaborators(first: {MAX_USERS}) @include(if: $users) {{
+    pageInfo {{ hasNextPage }}
+    nodes {{ login }}
+  }}
+  defaultBranchRef {{ target {{ oid }} }}
+  file: object(expression: $expression) {{
+    ... on Blob {{ text isBinary isTruncated }}
+  }}
+}}
+"""
+
+NAMES_QUERY = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name }
+    }
+  }
+}
+"""
+
+FORKS_QUERY = """
+query($owner: String!, $name: String!, $expression: String!,
+    $users: Boolean!, $first: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    forks(first: $first, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...repoFields }
+    }
+  }
+}
+""" + REPO_FIELDS
+
+
+def graphql_url(api_url):
+    """Get the GraphQL endpoint for a REST API URL."""
+    # GitHub Enterprise serves REST at /api/v3 and GraphQL at /api/graphql.
+    if api_url.endswith("/api/v3"):
+        return api_url[:-len("/v3")] + "/graphql"
+    return api_url + "/graphql"
+
+
+def query(client, text, variables):
+    """Run a GraphQL query, and return the data.
+
+    Fields that fail (for instance, collaborators of a repo the token can't
+    administer) are null in the data. Raises GitHubError if there's no data.
+    """
+    response = client.request("POST", graphql_url(client.api_url),
+        json = {"query": text, "variables": variables})
+    result = response.json()
+    if result.get("data") is None:
+        errors = result.get("errors") or [{"message": "No data"}]
+        raise GitHubError(response.status_code, errors[0]["message"])
+
+    return result["data"]
+
+
+def paginate(client, text, variables, path):
+    """Generate the nodes of a paginated connection, following the cursors.
+
+    The path is the list of keys from the data to the connection.
+    """
+    variables = dict(variables, cursor = None)
+    while True:
+        connection = query(client, text, variables)
+        for key in path:
+            connection = connection[key]
+
+        yield from connection["nodes"]
+
+        page = connection["pageInfo"]
+        if not page["hasNextPage"]:
+            return
+        variables["cursor"] = page["endCursor"]
+
+
+def batch_query(count):
+    """Make a query for count repos with the same owner, by name."""
+    names = "".join(f", $n{i}: String!" for i in range(count))
+    fields = "".join(
+        f"  r{i}: repository(owner: $owner, name: $n{i}) {{ ...repoFields }}\n"
+        for i in range(count))
+    return (f"query($owner: String!, $expression: String!, $users: Boolean!"
+        f"{names}) {{\n{fields}}}\n" + REPO_FIELDS)
+
+
+def org_repo_names(client, org, search = ""):
+    """Get the names of the repos in an org that contain the search term."""
+    nodes = paginate(client, NAMES_QUERY, {"org": org},
+        ["organization", "repositories"])
+    return [n["name"] for n in nodes if search in n["name"]]
+
+
+def repo_file(client, node, path, ignore):
+    """Make a RepoFile from a repo's fields, falling back to REST for what
+    the fields don't include.
+
+    If the collaborators weren't queried, the users are the repo's owner.
+    """
+    repo = {"name": node["name"], "full_name": node["nameWithOwner"],
+        "html_url": node["url"]}
+
+    try:
+        collaborators = node.get("collaborators", False)
+        if collaborators is False:
+            users = [node["owner"]["login"]]
+        elif collaborators is None:
+            raise GitHubError(403, "Can't list collaborators")
+        elif collaborators["pageInfo"]["hasNextPage"]:
+            users = ghapi.collaborators(client, repo, ignore)
+        else:
+            users = [u["login"] for u in collaborators["nodes"]
+                if u["login"] not in ignore]
+    except GitHubError as e:
+        return RepoFile(repo["name"], repo["html_url"], [], None, e)
+
+    branch = node["defaultBranchRef"]
+    head = branch["target"]["oid"] if branch is not None else None
+
+    blob = node["file"]
+    if blob is None:
+        return RepoFile(repo["name"], repo["html_url"], users, None,
+            GitHubError(404, "Not Found"), head)
+
+    if blob["isBinary"] or blob["isTruncated"] or blob["text"] is None:
+        try:
+            content = ghapi.file_contents(client, repo, path)
+        except GitHubError as e:
+            return RepoFile(repo["name"], repo["html_url"], users, None, e,
+                head)
+    else:
+        content = blob["text"].encode("utf-8")
+
+    return RepoFile(repo["name"], repo["html_url"], users, content, None,
+        head)
+
+
+def fetch_files(client, org, search, path, ignore = (), users = True,
+        batch = BATCH_SIZE):
+    """Fetch a file from each repo in an org whose name contains the search
+    term.
+
+    Generates a RepoFile for each repo, with the head commit of the default
+    branch. If users is False, the collaborators aren't queried.
+    """
+    names = org_repo_names(client, org, search)
+    variables = {"owner": org, "expression": f"HEAD:{path}",
+        "users": users}
+
+    for start in range(0, len(names), batch):
+        chunk = names[start:(start + batch)]
+        data = query(client, batch_query(len(chunk)), dict(variables,
+            **{f"n{i}": name for i, name in enumerate(chunk)}))
+
+        for i, name in enumerate(chunk):
+            node = data.get(f"r{i}")
+            if node is None:
+                # The repo was deleted after it was listed.
+                continue
+            yield repo_file(client, node, path, ignore)
+
+
+def fetch_forks(client, owner, name, path, ignore = (), users = False,
+        batch = BATCH_SIZE):
+    """Fetch a file from each fork of a repo.
+
+    Generates a RepoFile for each fork, as for fetch_files(). By default the
+    collaborators aren't queried, so the users are each fork's owner.
+    """
+    variables = {"owner": owner, "name": name, "expression": f"HEAD:{path}",
+        "users": users, "first": batch}
+    nodes = paginate(client, FORKS_QUERY, variables, ["repository", "forks"])
+    for node in nodes:
+        yield repo_file(client, node, path, ignore)
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
-from itertools import chain
 import getpass
 from pathlib import Path
 import sys
 
-import github
+import ghapi
+import ghcache
+import ghgraphql
 
 GH_ORG = "UCDSTA141B"
+API_URL = ghapi.API_URL
 ADMINS = ["jsharpna", "Chunjui", "nick-ulle"]
 
 def read_token(path = "token"):
@@ -25,9 +27,38 @@ def read_token(path = "token"):
 TOKEN = read_token()
 
 
-def get_user_logins(org):
-    users = chain(org.get_members(), org.get_outside_collaborators())
-    return sorted(u.login for u in users)
+def make_client(args):
+    """Make a GitHub client from the arguments added by
+    add_client_arguments().
+    """
+    cache = None
+    if not args.no_cache:
+        cache = ghcache.HTTPCache(args.cache_dir, args.cache_size * 2**20)
+
+    return ghapi.Client(TOKEN, args.api_url, args.jobs, cache = cache)
+
+
+def print_cache_stats(client):
+    if client.cache is not None:
+        print(f"{client.cache.hits} unchanged responses read from the cache.")
+
+
+def add_client_arguments(parser, backend = True):
+    parser.add_argument("-j", "--jobs", type = int, default = 8,
+        help = "number of requests to make at once")
+    parser.add_argument("--api-url", dest = "api_url", default = API_URL,
+        help = "URL of the GitHub API")
+    if backend:
+        parser.add_argument("--backend", choices = ["rest", "graphql"],
+            default = "rest", help = "API to fetch with; 'graphql' gets a "
+            "batch of repos per request")
+    parser.add_argument("--no-cache", dest = "no_cache", action = "store_true",
+        help = "don't use or update the response cache")
+    parser.add_argument("--cache-dir", dest = "cache_dir",
+        default = ghcache.CACHE_DIR, help = "path to response cache")
+    parser.add_argument("--cache-size", dest = "cache_size", type = int,
+        default = ghcache.MAX_BYTES // 2**20, metavar = "MB",
+        help = "most megabytes to keep in the response cache")
 
 
 def prompt(message):
@@ -41,7 +72,13 @@ def prompt(message):
 
 
 def gh_fetch_file(args):
-    """Fetch a file from all org repositories that match the search term."""
+    """Fetch a file from all org repositories that match the search term.
+
+    Up to '--jobs N' requests run at once, within GitHub's rate limit.
+    Responses are cached, so unchanged repos don't count against the limit
+    on later runs. With '--backend graphql', repos are fetched in batches
+    instead.
+    """
     path = args.path
     search = args.search
 
@@ -51,31 +88,32 @@ def gh_fetch_file(args):
     elif not prompt(f"'{out_dir}' already exists. Continue?"):
         return None
     
-    org = github.Github(TOKEN).get_organization(GH_ORG)
-    repos = (r for r in org.get_repos() if search in r.name)
-    
-    students = [s for s in get_user_logins(org) if s not in ADMINS]
+    client = make_client(args)
+    if args.backend == "graphql":
+        results = ghgraphql.fetch_files(client, GH_ORG, search, path, ADMINS)
+    else:
+        repos = ghapi.org_repos(client, GH_ORG, search)
+        results = ghapi.fetch_files(client, repos, path, ADMINS, args.jobs)
+
+    students = [
+        s for s in ghapi.user_logins(client, GH_ORG) if s not in ADMINS
+    ]
 
     print("Found notebooks:")
-    for repo in repos:
+    for result in results:
         # Figure out which students use this repo.
-        repo_users = [
-            u.login for u in repo.get_collaborators()
-            if u.login not in ADMINS
-        ]
-        if len(repo_users) == 0:
+        repo_users = result.users
+        if result.error is None and len(repo_users) == 0:
             # FIXME: This skips students that commit without setting up their
             # git email.
             continue
 
         # Find the file.
-        try:
-            content = repo.get_contents(path)
-        except github.GithubException as exc:
-            if "too large" in exc.data.get("message", ""):
-                print(f"Large '{path}' ({repo.html_url})")
+        if result.error is not None:
+            if "too large" in result.error.message:
+                print(f"Large '{path}' ({result.url})")
             else:
-                print(f"No '{path}' ({repo.html_url})")
+                print(f"No '{path}' ({result.url})")
             continue
 
         # Remove them from the list of students.
@@ -83,42 +121,52 @@ def gh_fetch_file(args):
 
         name = "_".join(repo_users) + ".ipynb"
         with open(out_dir / name, "wb") as f:
-            f.write(content.decoded_content)
-        print(f"{name} ({repo.html_url})")
+            f.write(result.content)
+        print(f"{name} ({result.url})")
 
     if len(students) != 0:
         print("\nNo notebook found for:")
         print("\n".join(students))
 
+    print_cache_stats(client)
     print("\nFinished!")
 
 
-# ------------------------------------------------------------
-# Monkey-patch a method for getting outside collaborators.
-# Based on PyGithub PR #533 from @jappievw.
-def get_outside_collaborators(self, filter_=github.GithubObject.NotSet):
-    """
-    :calls: `GET /orgs/:org/outside_collaborators <http://developer.github.com/v3/orgs/outside_collaborators>`_
-    :param filter_: string
-    :rtype: :class:`github.PaginatedList.PaginatedList` of :class:`github.NamedUser.NamedUser`
+def gh_fetch_archive(args):
+    """Download the archive of all org repositories that match the search
+    term, and extract the files that match the globs.
+
+    Each repo takes one request, so this is faster than running fetch once
+    per file. Up to '--jobs N' archives download at once, and each is
+    streamed to disk. Files are saved as 'TARGET/REPO/PATH'.
     """
-    assert (filter_ is github.GithubObject.NotSet or
-            isinstance(filter_, (str, unicode))), filter_
+    out_dir = Path(args.target)
+    if not out_dir.is_dir():
+        out_dir.mkdir()
+    elif not prompt(f"'{out_dir}' already exists. Continue?"):
+        return None
+
+    patterns = args.include or ["*"]
+    client = make_client(args)
+    repos = ghapi.org_repos(client, GH_ORG, args.search)
+
+    print("Found repos:")
+    n_files = 0
+    for result in ghapi.fetch_archives(client, repos, out_dir, patterns,
+            args.jobs):
+        if result.error is not None:
+            print(f"No archive: {result.error} ({result.url})")
+            continue
+        if len(result.paths) == 0:
+            print(f"No matching files ({result.url})")
+            continue
 
-    url_parameters = {}
-    if filter_ is not github.GithubObject.NotSet:
-        url_parameters["filter"] = filter_
-    return github.PaginatedList.PaginatedList(
-        github.NamedUser.NamedUser,
-        self._requester,
-        self.url + "/outside_collaborators",
-        url_parameters
-    )
+        n_files += len(result.paths)
+        print(f"{result.name}: {len(result.paths)} files ({result.url})")
 
-github.Organization.Organization.get_outside_collaborators = (
-    get_outside_collaborators
-)
-# ------------------------------------------------------------
+    print(f"\nExtracted {n_files} files.")
+    print_cache_stats(client)
+    print("\nFinished!")
 
 
 def main():
@@ -132,8 +180,21 @@ def main():
         help = "term to require in repo name")
     p_fetch.add_argument("target", nargs = "?", default = "submissions",
         help = "path to output directory")
+    add_client_arguments(p_fetch)
     p_fetch.set_defaults(subprogram = gh_fetch_file)
 
+    # Archive Tool Arguments ----------------------------------------
+    p_archive = sp.add_parser("archive")
+    p_archive.add_argument("search", nargs = "?", default = "",
+        help = "term to require in repo name")
+    p_archive.add_argument("target", nargs = "?", default = "submissions",
+        help = "path to output directory")
+    p_archive.add_argument("-i", "--include", action = "append",
+        metavar = "GLOB", help = "extract files whose path in the repo "
+        "matches GLOB (default: all files); can be repeated")
+    add_client_arguments(p_archive, backend = False)
+    p_archive.set_defaults(subprogram = gh_fetch_archive)
+
     # Parse arguments and run subprogram
     args = ap.parse_args()
     args.subprogram(args)
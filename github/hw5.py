@@ -2,12 +2,13 @@
 
 # Fetch the student hw5 repos
 
-import base64
+import argparse
 from pathlib import Path
 
-import github
-
-from ghtool import TOKEN, GH_ORG, ADMINS, get_user_logins
+import ghapi
+import ghgraphql
+from ghtool import (GH_ORG, ADMINS, make_client, print_cache_stats,
+    add_client_arguments)
 
 SEARCH = "hw5"
 
@@ -15,39 +16,82 @@ MISSING = [
         # Missing accounts go here
 ]
 
-def fork():
-    path = "hw5.ipynb"
-    out_dir = Path("hw5")
-    students = MISSING.copy()
+# The commit the student repos start from.
+TEMPLATE_SHA = "fdb8f971eae992ec1f723bcc38019f257b869f68"
 
-    gh = github.Github(TOKEN)
 
-    james = gh.get_user("jsharpna")
-    origin_repo = james.get_repo("sta141b-hw5")
+def rest_files(client, repos, path, template_sha, ignore = None):
+    """Generate a RepoFile for each repo with REST requests. The file is only
+    fetched if the repo has commits after the template commit.
 
-    for fork in origin_repo.get_forks():
-        name = fork.owner.login
+    If ignore is None, the collaborators aren't looked up, and the users are
+    the repo's owner. Otherwise repos without users aren't checked further.
+    """
+    for repo in repos:
+        name = repo["name"]
+        html_url = repo["html_url"]
+
+        if ignore is None:
+            users = [repo["owner"]["login"]]
+        else:
+            users = ghapi.collaborators(client, repo, ignore)
+            if len(users) == 0:
+                yield ghapi.RepoFile(name, html_url, users, None, None)
+                continue
 
-        # Check that the repo has commits.
+        # Check that the repo has new commits.
         try:
-            hashes = [x.sha for x in fork.get_commits()]
-            if hashes[0] == "fdb8f971eae992ec1f723bcc38019f257b869f68":
-                print(f"  No change ({fork.html_url})")
-                continue
-        except github.GithubException as exc:
-            print(f"  No commits ({fork.html_url})")
+            status, head = ghapi.submission_status(client, repo, template_sha)
+        except ghapi.GitHubError as exc:
+            yield ghapi.RepoFile(name, html_url, users, None, exc)
+            continue
+
+        if status != ghapi.CHANGED:
+            yield ghapi.RepoFile(name, html_url, users, None, None, head)
             continue
 
         # Find the file.
-        contents = fork.get_dir_contents("/")
-        contents = [x for x in contents if x.path == path]
-        if len(contents) == 0:
-            print(f"  No '{path}' ({fork.html_url})")
+        try:
+            content = ghapi.file_contents(client, repo, path)
+        except ghapi.GitHubError as exc:
+            yield ghapi.RepoFile(name, html_url, users, None, exc, head)
             continue
 
-        blob = fork.get_git_blob(contents[0].sha)
-        blob = bytearray(blob.content, "utf-8")
-        content = base64.b64decode(blob)
+        yield ghapi.RepoFile(name, html_url, users, content, None, head)
+
+
+def check(result, path, template_sha):
+    """Print why a result has no notebook, and return whether it has one."""
+    status = ghapi.head_status(result.head, template_sha)
+    if status == ghapi.EMPTY:
+        print(f"  No commits ({result.url})")
+    elif status == ghapi.UNCHANGED:
+        print(f"  No change ({result.url})")
+    elif result.error is not None:
+        print(f"  No '{path}' ({result.url})")
+    else:
+        return True
+
+    return False
+
+
+def fork(client, backend, template_sha = TEMPLATE_SHA):
+    path = "hw5.ipynb"
+    out_dir = Path("hw5")
+    students = MISSING.copy()
+
+    if backend == "graphql":
+        results = ghgraphql.fetch_forks(client, "jsharpna", "sta141b-hw5",
+            path)
+    else:
+        forks = client.paginate("/repos/jsharpna/sta141b-hw5/forks")
+        results = rest_files(client, forks, path, template_sha)
+
+    for result in results:
+        name = result.users[0]
+        if not check(result, path, template_sha):
+            continue
+        content = result.content
 
         # Remove them from the list of students.
         students = [s for s in students if s != name]
@@ -59,78 +103,76 @@ def fork():
             with open(fname, "rb") as f:
                 old_content = f.read()
             if old_content == content:
-                print(f"{name} ({fork.html_url})")
+                print(f"{name} ({result.url})")
             else:
-                print(f"  Exists: '{path}' ({fork.html_url})")
+                print(f"  Exists: '{path}' ({result.url})")
             continue
 
         with open(fname, "wb") as f:
             f.write(content)
-        print(f"{name} ({fork.html_url})")
+        print(f"{name} ({result.url})")
 
     if len(students) != 0:
         print("\nNo notebook found for:")
         print("\n".join(students))
 
+    print_cache_stats(client)
     print("\nFinished!")
 
 
-def main():
+def org(client, backend, template_sha = TEMPLATE_SHA):
     path = "hw5.ipynb"
     out_dir = Path("hw5")
 
-    gh = github.Github(TOKEN)
-    org = gh.get_organization(GH_ORG)
-    students = [s for s in get_user_logins(org) if s not in ADMINS]
+    students = [
+        s for s in ghapi.user_logins(client, GH_ORG) if s not in ADMINS
+    ]
 
     # First try to get the hw5 repos from the org.
-    repos = (r for r in org.get_repos() if SEARCH in r.name)
+    if backend == "graphql":
+        results = ghgraphql.fetch_files(client, GH_ORG, SEARCH, path, ADMINS)
+    else:
+        repos = ghapi.org_repos(client, GH_ORG, SEARCH)
+        results = rest_files(client, repos, path, template_sha, ADMINS)
 
     print("Found notebooks:")
-    for repo in repos:
+    for result in results:
         # Figure out which students use this repo.
-        repo_users = [
-            u.login for u in repo.get_collaborators()
-            if u.login not in ADMINS
-        ]
-        if len(repo_users) == 0:
-            continue
-
-        # Check that the repo has commits.
-        try:
-            hashes = [x.sha for x in repo.get_commits()]
-            if hashes[0] == "fdb8f971eae992ec1f723bcc38019f257b869f68":
-                print(f"  No change ({repo.html_url})")
-                continue
-        except github.GithubException as exc:
-            print(f"  No commits ({repo.html_url})")
-            continue
-
-        # Find the file.
-        contents = repo.get_dir_contents("/")
-        contents = [x for x in contents if x.path == path]
-        if len(contents) == 0:
-            print(f"  No '{path}' ({repo.html_url})")
+        repo_users = result.users
+        if len(repo_users) == 0 or not check(result, path, template_sha):
             continue
 
-        blob = repo.get_git_blob(contents[0].sha)
-        blob = bytearray(blob.content, "utf-8")
-        content = base64.b64decode(blob)
-
         # Remove them from the list of students.
         students = [s for s in students if s not in repo_users]
 
         name = "_".join(repo_users) + ".ipynb"
         with open(out_dir / name, "wb") as f:
-            f.write(content)
-        print(f"{name} ({repo.html_url})")
+            f.write(result.content)
+        print(f"{name} ({result.url})")
 
     if len(students) != 0:
         print("\nNo notebook found for:")
         print("\n".join(students))
 
+    print_cache_stats(client)
     print("\nFinished!")
 
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--org", action = "store_true",
+        help = "collect from the org's repos instead of forks")
+    ap.add_argument("--template", default = TEMPLATE_SHA, metavar = "SHA",
+        help = "SHA of the template commit; repos still at it are skipped")
+    add_client_arguments(ap)
+    args = ap.parse_args()
+
+    client = make_client(args)
+    if args.org:
+        org(client, args.backend, args.template)
+    else:
+        fork(client, args.backend, args.template)
+
+
 if __name__ == "__main__":
-    #main()
-    fork()
+    main()
@@ -6,14 +6,25 @@ notebooks.
 """
 
 import argparse
+from collections import Counter
 import glob
 import nbformat as nb
 import os.path
+import re
+import sys
+
+# Make the ucdtools package importable when this is run as a script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ucdtools.notebook as note
+import ucdtools.pipeline as pipeline
 
 
 # Configuration Variables
 SOLN_SUFFIX = '-solutions.ipynb'
 SOLN_HEADER = '#### SOLUTION' # header for solution cells
+# In these notebooks, exercise cells start with a header like
+# '__Exercise 1.1.__' and aren't tagged.
+EXERCISE_PATTERN = re.compile(r'^__Exercise (\S+?)\.?__')
 
 EXERCISE_POINTS = {
       '1.1': 20, '1.2': 40, '1.3': 10, '1.4': 10
@@ -65,38 +76,49 @@ def nb_grade(args):
             return None
 
     # Convert the notebooks.
-    for path in paths:
-        target = os.path.join(args.target, os.path.basename(path))
-        print(f"'{path} -> {target}'")
-
-        notebook = nb.read(path, 4)
-
-        # Insert a grade cell before every exercise cell.
-        i = 0
-        cells = notebook['cells']
-        while i < len(cells):
-            cell = cells[i]
-            # In newer assignment notebooks we can check metadata instead.
-            if cell['source'].startswith('__Exercise'):
-                # Exercise cell: insert a new grade cell before.
-                grade_cell = create_grade_cell(cell)
-                cells.insert(i, grade_cell)
-                i += 2
-            elif cell['metadata'].get('name', '').startswith('gr'):
-                # Grade cell: skip past the subsequent exercise cell.
-                i += 2
-            else:
-                i += 1
-
-        nb.validate(notebook)
-        nb.write(notebook, target)
-
-
-def create_grade_cell(cell):
-    """Create a grade cell for an exercise cell."""
-    header = cell['source'].split('__')[1]
-    ex_number = header.strip('_.').split(' ')[-1]
+    def discover():
+        for i, path in enumerate(paths):
+            target = os.path.join(args.target, os.path.basename(path))
+            print(f"'{path} -> {target}'")
+            full = note.use_full_validation(args.validate, i, args.sample_every)
+            yield (path, target, full)
+
+    counts = Counter()
+    for validation in pipeline.imap(convert_notebook, discover(),
+            args.jobs, args.in_flight):
+        counts.update(validation)
+
+    print(note.format_validation_counts(counts))
+
+
+def convert_notebook(path, target, full):
+    """Insert grade cells into one notebook and write it to the target path.
+
+    Returns the validation counts for the notebook.
+    """
+    before = Counter(note.VALIDATION_COUNTS)
+    notebook = note.read_notebook(path)
 
+    # Insert a grade cell before every exercise cell that doesn't have one.
+    cells = notebook['cells']
+    with_id = note.uses_cell_ids(notebook)
+    inserts = {}
+    for i, ex_number, _ in note.exercise_index(cells, EXERCISE_PATTERN, None):
+        prev = cells[i - 1] if i > 0 else None
+        if prev and prev['metadata'].get('name', '').startswith('gr'):
+            continue
+        inserts[i] = create_grade_cell(ex_number, with_id)
+
+    notebook['cells'] = note.interleave_cells(cells, inserts, before = True)
+
+    note.validate(notebook, full)
+    note.write_notebook(notebook, target)
+
+    return dict(note.VALIDATION_COUNTS - before)
+
+
+def create_grade_cell(ex_number, with_id = True):
+    """Create a grade cell for an exercise number."""
     points = EXERCISE_POINTS[ex_number]
     text = (
         '<strong style="color:#F00">\n'
@@ -105,10 +127,7 @@ def create_grade_cell(cell):
         '</strong>'
     )
 
-    grade_cell = nb.v4.new_markdown_cell(text)
-    grade_cell['metadata']['name'] = f'gr{ex_number}'
-
-    return grade_cell
+    return note.markdown_cell(text, {'name': f'gr{ex_number}'}, with_id)
 
 
 def main():
@@ -124,6 +143,17 @@ def main():
     p_grade = sp.add_parser('grade')
     p_grade.add_argument('source', help = 'path to input directory')
     p_grade.add_argument('target', help = 'path to output directory')
+    p_grade.add_argument('--validate', default = 'full',
+        choices = note.VALIDATION_POLICIES,
+        help = 'which notebooks get the full schema check')
+    p_grade.add_argument('--sample-every', dest = 'sample_every', type = int,
+        default = 10, metavar = 'N',
+        help = "with '--validate sampled', fully check every Nth notebook")
+    p_grade.add_argument('-j', '--jobs', type = int, default = 1,
+        help = 'number of notebooks to convert at once')
+    p_grade.add_argument('--in-flight', dest = 'in_flight', type = int,
+        metavar = 'N', help = 'most notebooks in progress at once '
+        '(default: twice the number of jobs)')
     p_grade.set_defaults(subprogram = nb_grade)
 
     # Parse arguments and run subprogram
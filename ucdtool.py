@@ -8,53 +8,174 @@ To use this as a script, run
 where NAME is the assignment name and OUT is the directory to clone into.
 """
 import argparse
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import sys
 from urllib.parse import urljoin
 
-import pandas as pd
-
 import config as cfg
-import ucdtools.git as git
-import ucdtools.notebook as note
-import ucdtools.io as io
+import ucdtools
+import ucdtools.cache as cache
+import ucdtools.pipeline as pipeline
+import ucdtools.timing as timing
+
+# pandas, pygit2, and nbformat are slow to import, so they're imported by the
+# subprograms that use them instead of here.
+
+# Name of the shared reference repository inside the clone directory.
+REFERENCE_NAME = ".reference.git"
+# Name of the journal of pushed repos inside the repositories directory.
+PUSH_JOURNAL_NAME = ".push_journal"
+# Name of the manifest of prepared notebooks inside the repositories
+# directory.
+PREPARE_MANIFEST_NAME = ".prepare.json"
+# Name of the grade cache inside the repositories directory.
+GRADE_CACHE_NAME = ".grades.json"
+
+
+def clone_student(base_url, user, dest, cred, use_cache, update = False,
+        recorder = None, **kwargs):
+    """Clone one student's repository, falling back to the '-1' URL that
+    GitHub Classroom uses when a repo name is already taken.
+
+    Returns a (status, url, error) tuple, where status is one of 'cloned',
+    'skipped', 'fallback', or 'failed'. In update mode, existing repos are
+    fetched instead, and status is a result from git.update_repo().
+
+    If a timing recorder is given, the clone or update is timed.
+
+    Other keyword arguments are passed on to git.clone().
+    """
+    import ucdtools.git as git
+
+    url = "{}-{}.git".format(base_url, user)
+
+    if update and dest.exists():
+        try:
+            repo = git.open_repo(dest)
+            url = repo.remotes["origin"].url
+            with timing.stage(recorder, dest.name, "update") as stage:
+                status = git.update_repo(repo, cred, stage = stage)
+            git.print_lines("{} '{}'".format(status.capitalize(), dest))
+            return (status, url, None)
+        except Exception as e:
+            git.print_lines("Failed to update '{}'".format(dest),
+                    "  {}".format(e))
+            return ("failed", url, e)
+
+    status = "skipped" if use_cache and dest.exists() else "cloned"
+
+    try:
+        with timing.stage(recorder, dest.name, "clone") as stage:
+            git.clone(url, dest, cred, use_cache, stage = stage, **kwargs)
+        return (status, url, None)
+    except Exception as e:
+        failed = url
+        url = "{}-{}-1.git".format(base_url, user)
+        git.print_lines("Failed to clone '{}'".format(failed),
+                "  {}".format(e), "Trying new url '{}'".format(url))
+
+    try:
+        with timing.stage(recorder, dest.name, "clone") as stage:
+            git.clone(url, dest, cred, use_cache, stage = stage, **kwargs)
+        return ("fallback", url, None)
+    except Exception as e:
+        git.print_lines("Failed to clone '{}'".format(url),
+                "  {}".format(e))
+        return ("failed", url, e)
+
+
+def print_summary(results, statuses):
+    """Print a table counting the results with each status, followed by the
+    names of the repos that failed.
+
+    The results map repo names to tuples. The first element of each tuple is
+    the status, and the second is printed next to the repo if it failed.
+    """
+    counts = {s: 0 for s in statuses}
+    for result in results.values():
+        counts[result[0]] += 1
+
+    width = max(len(s) for s in statuses + ["Status"])
+    print("\n{:<{}} | Count".format("Status", width))
+    print("{} | -----".format("-" * width))
+    for status in statuses:
+        print("{:<{}} | {}".format(status, width, counts[status]))
+
+    failed = [(name, r[1]) for name, r in sorted(results.items())
+            if r[0] == "failed"]
+    if failed:
+        print("\nFailed:")
+        for name, detail in failed:
+            print("  {} ({})".format(name, detail))
 
 
 def do_clone(args):
     """This subprogram clones all repositories for the user-specified
     assignment, by combining the base URL, the assignment name, and each
     username.
+
+    With '--jobs N', up to N clones run at once in a thread pool; pygit2
+    releases the GIL while waiting on the network.
+
+    The cloned repos are recorded in a manifest in the destination
+    directory, which the other subprograms use to find them.
+
+    With '--reference URL', the template repository is cloned once into a
+    bare repository in the destination directory, and every student clone
+    borrows the template's objects from it.
     """
+    import pandas as pd
+
+    import ucdtools.git as git
+
     roster = pd.read_csv(args.users).iloc[:, :2]
 
     base_url = urljoin(cfg.base_url, args.name)
     use_ssh = base_url.startswith("git")
-    cred = git.get_credentials(use_ssh)
+    cred = git.CredentialProvider(use_ssh)
 
     # Create dest directory if not already present.
     dest = Path(args.dest)
     dest.mkdir(parents = True, exist_ok = True)
 
-    print("Cloning repositories...")
-    for email, user in roster.itertuples(index = False):
-        url = "{}-{}.git".format(base_url, user)
+    reference = None
+    if args.reference:
+        print("Fetching reference '{}'...".format(args.reference))
+        reference = git.init_reference(args.reference,
+                dest / REFERENCE_NAME, cred)
 
-        repo_dest = dest / email.partition("@")[0]
-
-        try:
-            git.clone(url, repo_dest, cred, args.use_cache)
-        except Exception as e:
-            print("Failed to clone '{}'".format(url))
-            print("  {}".format(e))
-            url = "{}-{}-1.git".format(base_url, user)
-            print("Trying new url '{}'".format(url))
-
-            try:
-                git.clone(url, repo_dest, cred, args.use_cache)
-            except Exception as e:
-                print("Failed to clone '{}'".format(url))
-                print("  {}".format(e))
+    print("Cloning repositories...")
+    results = {}
+    with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        futures = {}
+        for email, user in roster.itertuples(index = False):
+            name = email.partition("@")[0]
+            future = pool.submit(clone_student, base_url, user, dest / name,
+                    cred, args.use_cache, args.update, args.recorder,
+                    reference = reference,
+                    depth = args.depth, single_branch = args.single_branch)
+            futures[future] = (name, email, user)
+
+        entries = {}
+        for future in as_completed(futures):
+            name, email, user = futures[future]
+            results[name] = future.result()
+            git.print_lines("[{}/{}] {}: {}".format(len(results),
+                len(futures), name, results[name][0]))
+
+            status, url, error = results[name]
+            if status != "failed":
+                entries[name] = {"email": email, "user": user, "url": url}
+
+    # Record the repos so later subprograms don't have to scan for them.
+    git.update_manifest(dest, entries)
+
+    statuses = ["cloned", "skipped", "fallback", "failed"]
+    if args.update:
+        statuses[1:2] = ["current", "updated", "ahead", "diverged"]
+    print_summary(results, statuses)
 
 
 def do_prepare(args):
@@ -63,28 +184,149 @@ def do_prepare(args):
     
     1. Print names of repos where the latest commit is after the due date.
     2. Create a 'feedback.ipynb' file from the homework file.
+
+    Step 2 is skipped for repos where the homework file hasn't changed since
+    the last run, according to a manifest in the directory. Feedback files
+    that were edited after they were created are kept unless '--force' is
+    set.
+
+    With '--jobs N', the notebooks are prepared in a pool of N processes,
+    with at most '--in-flight' of them in progress at once.
+
+    The '--validate' policy sets which notebooks get the full schema check
+    before they're written: all of them, every nth one ('sampled'), or none
+    ('structural'). Notebooks that fail a quick structural check always get
+    the full check.
+
+    With '--max-output BYTES', cell outputs larger than BYTES are truncated,
+    downsampled, or dropped in the feedback files.
     """
-    due = datetime.strptime(args.due, "%m.%d %H:%M")
-    due = due.replace(year = cfg.year, tzinfo = cfg.tzinfo)
+    import ucdtools.dates as dates
+    import ucdtools.git as git
+    import ucdtools.notebook as note
+
+    due = dates.parse_due(args.due, cfg.year, cfg.tzinfo)
 
     repos = git.discover_repos(args.path)
+    manifest_path = Path(args.path) / PREPARE_MANIFEST_NAME
+    manifest = cache.read_json(manifest_path, {})
+
+    def discover():
+        for i, repo in enumerate(repos):
+            git.check_late(repo, due)
+            path = Path(repo.path).parent
+            full = note.use_full_validation(args.validate, i,
+                    args.sample_every)
+            yield (path, args.rubric, manifest.get(path.name), args.force,
+                    full, args.max_output, args.recorder is not None)
+
+    results = {}
+    validation = Counter()
+    saved = 0
+    for result in pipeline.imap(note.prepare_repo, discover(), args.jobs,
+            args.in_flight):
+        results[result.name] = (result.status, result.message)
+        if args.recorder is not None:
+            args.recorder.extend(result.timings)
+        validation.update(result.validation)
+        saved += result.saved
+        if result.saved:
+            print("Capped outputs ({}): saved {:,} bytes".format(result.name,
+                result.saved))
+        if result.record is not None:
+            manifest[result.name] = result.record
+        if result.status not in ("created", "skipped"):
+            print("{} ({}): {}".format(result.status.capitalize(),
+                result.name, result.message))
+
+    cache.write_json(manifest_path, manifest)
+
+    print_summary(results, list(note.PREPARE_STATUSES))
+    print("\n" + note.format_validation_counts(validation))
+    if args.max_output:
+        print("Capped outputs: saved {:,} bytes in total".format(saved))
+
+
+def do_late(args):
+    """This subprogram writes a CSV report of late submissions for all
+    repositories in a directory.
 
+    The head commit of every repo is read (up to '--jobs N' at once), and
+    cached so that later runs only read repos whose HEAD changed. Commits
+    more than '--grace' minutes past the due date are late. Per-student due
+    dates can be given in an extensions file.
+    """
+    import ucdtools.dates as dates
+    import ucdtools.git as git
+    import ucdtools.late as late
+
+    due = dates.parse_due(args.due, cfg.year, cfg.tzinfo)
+
+    extensions = None
+    if args.extensions:
+        extensions = late.read_extensions(args.extensions, cfg.year,
+                cfg.tzinfo)
+
+    repos = git.discover_repos(args.path)
+    commits = late.collect_commits(args.path, repos, args.jobs)
+    report = late.late_report(commits, due, args.grace, extensions)
+
+    collected = set(commits["repo"])
     for repo in repos:
-        git.check_late(repo, due)
-        if args.rubric:
-            note.init_rubric(Path(repo.path).parent)
-        else:
-            note.init_feedback(Path(repo.path).parent)
+        name = Path(repo.path).parent.name
+        if name not in collected:
+            print("No commits in '{}'".format(repo.path))
+
+    # Add emails for repos that were cloned with a roster.
+    manifest = git.read_manifest(args.path)
+    emails = [manifest.get(name, {}).get("email") for name in report["repo"]]
+    report.insert(1, "email", emails)
+
+    report.to_csv(args.output, index = False)
+
+    is_late = report[report["late"]]
+    for name, submitted in zip(is_late["repo"], is_late["submitted"]):
+        print("Late ({}): {}".format(name, submitted))
+    print("{} of {} repos late. Wrote '{}'.".format(len(is_late), len(report),
+        args.output))
+
 
-    
 def do_grade(args):
     """This subprogram extracts grades from all repositories in a directory and
     saves the grades into a gradebook.
+
+    With '--jobs N', the notebooks are graded in a pool of N processes,
+    with at most '--in-flight' of them in progress at once.
+    Grades are cached by the blob OID of each feedback notebook, so only
+    notebooks that changed since the last run are parsed again.
     """
+    import pandas as pd
+
+    import ucdtools.git as git
+    import ucdtools.io as io
+    import ucdtools.notebook as note
+
     # Compute grades for all repos.
     repos = git.discover_repos(args.path)
+    paths = [Path(repo.path).parent for repo in repos]
+
+    cache_path = Path(args.path) / GRADE_CACHE_NAME
+    cached = cache.read_json(cache_path, {})
+    items = ((p, cached.get(p.name)) for p in paths)
+
+    grades = []
+    updated = {}
+    for result in pipeline.imap(note.grade_repo, items, args.jobs,
+            args.in_flight):
+        for error in result.errors:
+            print("{}{} ({})".format(error[0].upper(), error[1:],
+                result.name))
+        if result.oid is not None:
+            updated[result.name] = result._asdict()
+        grades.append((result.name, result.grade))
+
+    cache.write_json(cache_path, updated)
 
-    grades = [note.compute_grade(Path(repo.path).parent) for repo in repos]
     grades = pd.DataFrame(grades, columns = ["email", "grade"])
 
     # Read file that links GH <-> SIS ID <-> Email
@@ -115,13 +357,28 @@ def do_grade(args):
 def do_commit(args):
     """This subprogram adds and commits a user-specified file for all
     repositories in a directory.
+
+    With '--no-index', the file is committed straight from the working tree
+    (see git.commit_file()), which is much faster in repos with many files.
+    The index is left behind HEAD; a later commit without '--no-index'
+    resets it first, but with git itself, run 'git reset' before committing.
     """
+    import ucdtools.git as git
+
     repos = git.discover_repos(args.path)
 
     for repo in repos:
+        name = Path(repo.path).parent.name
         try:
-            git.add(repo, args.file)
-            git.commit(repo, args.message)
+            with timing.stage(args.recorder, name, "commit") as stage:
+                if args.no_index:
+                    oid = git.commit_file(repo, args.file, args.message)
+                    if oid is None:
+                        print("Unchanged '{}'".format(repo.path))
+                else:
+                    git.add(repo, args.file)
+                    git.commit(repo, args.message)
+                stage.read(Path(repo.workdir) / args.file)
         except IOError as e:
             print("Failed to commit '{}'".format(repo.path))
             print("  {}".format(e))
@@ -131,22 +388,117 @@ def do_commit(args):
 def do_push(args):
     """This subprogram pushes to 'origin/master' for all repositories in a
     directory.
+
+    Up to '--jobs N' pushes run at once, and pushes that fail with a network
+    error are retried with exponential backoff. Rejected pushes fail right
+    away. Each successful push is recorded in a journal in the
+    directory, so that running the subprogram again skips repos that were
+    already pushed at their current commit. Delete the journal to push
+    everything again.
     """
+    import ucdtools.git as git
+
     repos = git.discover_repos(args.path)
+    journal = Path(args.path) / PUSH_JOURNAL_NAME
+    pushed = git.read_push_journal(journal)
 
     use_ssh = cfg.base_url.startswith("git")
-    cred = git.get_credentials(use_ssh)
+    cred = git.CredentialProvider(use_ssh)
 
-    for repo in repos:
-        try:
-            git.push(repo, cred)
-            print("Pushed '{}'".format(repo.path))
-        except Exception as e:
-            print("Failed to push '{}'".format(repo.path))
-            print("  {}".format(e))
+    results = {}
+    with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        futures = {}
+        for repo in repos:
+            name = Path(repo.path).parent.name
+            try:
+                url = repo.remotes["origin"].url
+                oid = str(repo.head.target)
+            except Exception as e:
+                git.print_lines("Failed to push '{}'".format(repo.path),
+                        "  {}".format(e))
+                results[name] = ("failed", None, e)
+                continue
+
+            if pushed.get(name) == oid:
+                git.print_lines("Skipped '{}'".format(repo.path))
+                results[name] = ("skipped", url, None)
+                continue
+
+            future = pool.submit(push_repo, repo, cred, args.retries,
+                    args.recorder)
+            futures[future] = (name, url, oid, repo.path)
+
+        for future in as_completed(futures):
+            name, url, oid, path = futures[future]
+            try:
+                future.result()
+                git.write_push_journal(journal, name, oid)
+                git.print_lines("Pushed '{}'".format(path))
+                results[name] = ("pushed", url, None)
+            except Exception as e:
+                git.print_lines("Failed to push '{}'".format(path),
+                        "  {}".format(e))
+                results[name] = ("failed", url, e)
+
+    print_summary(results, ["pushed", "skipped", "failed"])
+
+
+def push_repo(repo, cred, retries, recorder = None):
+    """Push a repo with git.push_with_retry(), timing the push if a timing
+    recorder is given.
+    """
+    import ucdtools.git as git
 
+    with timing.stage(recorder, Path(repo.path).parent.name,
+            "push") as stage:
+        git.push_with_retry(repo, cred, retries, stage = stage)
 
-def main():
+
+def run_subprogram(args):
+    """Run the subprogram for the parsed arguments, with timing and
+    profiling if they were requested.
+    """
+    args.recorder = None
+    if args.timings or args.trace:
+        args.recorder = timing.Recorder()
+
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        args.subprogram(args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print("\nWrote profile '{}'.".format(args.profile))
+
+        if args.recorder is not None:
+            print("\n" + timing.format_summary(args.recorder.records))
+            if args.trace:
+                timing.write_trace(args.recorder.records, args.trace)
+                print("Wrote trace '{}'.".format(args.trace))
+
+
+def add_pipeline_arguments(parser, help):
+    parser.add_argument("-j", "--jobs", type = int, default = 1, help = help)
+    parser.add_argument("--in-flight", dest = "in_flight", type = int,
+            metavar = "N", help = "most notebooks in progress at once "
+            "(default: twice the number of jobs)")
+
+
+def add_validation_arguments(parser):
+    parser.add_argument("--validate", default = "full",
+            choices = ucdtools.VALIDATION_POLICIES,
+            help = "which notebooks get the full schema check")
+    parser.add_argument("--sample-every", dest = "sample_every", type = int,
+            default = 10, metavar = "N",
+            help = "with '--validate sampled', fully check every Nth notebook")
+
+
+def main(argv = None):
     ap = argparse.ArgumentParser()
     if sys.version_info[0] != 3:
         print("Must use Python 3!")
@@ -157,14 +509,34 @@ def main():
         sp = ap.add_subparsers(help = "action to take", required = True,
                 dest = "subcommand")
 
+    # Timing Arguments ----------------------------------------
+    ap.add_argument("--timings", action = "store_true",
+            help = "print how long each stage took for each repo")
+    ap.add_argument("--trace", metavar = "FILE",
+            help = "write stage timings as a Chrome trace (implies "
+            "--timings)")
+    ap.add_argument("--profile", metavar = "FILE",
+            help = "write cProfile statistics for the main process")
+
     # Clone Tool Arguments ----------------------------------------
     p_clone = sp.add_parser("clone")
     p_clone.add_argument("dest", help = "path to output directory")
     p_clone.add_argument("name", help = "name of assignment")
     p_clone.add_argument("users", help = "path to usernames file",
             default = cfg.users, nargs = "?")
-    p_clone.add_argument("--overwrite", dest = "use_cache",
+    p_clone.add_argument("--reference", metavar = "URL",
+            help = "template repository to share objects with")
+    p_clone.add_argument("--depth", type = int, default = 0,
+            help = "number of commits of history to clone (0 for all)")
+    p_clone.add_argument("--single-branch", dest = "single_branch",
+            action = "store_true", help = "only clone the master branch")
+    g_clone = p_clone.add_mutually_exclusive_group()
+    g_clone.add_argument("--overwrite", dest = "use_cache",
             action = "store_false", help = "overwrite cached repositories")
+    g_clone.add_argument("--update", dest = "update", action = "store_true",
+            help = "fetch and fast-forward cached repositories")
+    p_clone.add_argument("-j", "--jobs", type = int, default = 1,
+            help = "number of repositories to clone at once")
     p_clone.set_defaults(subprogram = do_clone)
 
     # Prepare Tool Arguments ----------------------------------------
@@ -173,8 +545,29 @@ def main():
     p_prepare.add_argument("due", help = "due date in 'MM.DD hh:mm' format")
     p_prepare.add_argument("--rubric", dest = "rubric",
             action = "store_true", help = "use rubric grading")
+    add_pipeline_arguments(p_prepare,
+            help = "number of notebooks to prepare at once")
+    p_prepare.add_argument("--force", dest = "force", action = "store_true",
+            help = "replace feedback files that were edited")
+    add_validation_arguments(p_prepare)
+    p_prepare.add_argument("--max-output", dest = "max_output", type = int,
+            metavar = "BYTES", help = "shrink cell outputs larger than this")
     p_prepare.set_defaults(subprogram = do_prepare)
 
+    # Late Tool Arguments ----------------------------------------
+    p_late = sp.add_parser("late")
+    p_late.add_argument("path", help = "path to repositories directory")
+    p_late.add_argument("due", help = "due date in 'MM.DD hh:mm' format")
+    p_late.add_argument("--grace", type = float, default = 0,
+            help = "minutes after the due date to allow")
+    p_late.add_argument("--extensions",
+            help = "path to CSV file with 'email' and 'due' columns")
+    p_late.add_argument("-o", "--output", default = "late.csv",
+            help = "path to output CSV file")
+    p_late.add_argument("-j", "--jobs", type = int, default = 1,
+            help = "number of repositories to read at once")
+    p_late.set_defaults(subprogram = do_late)
+
     # Grade Tool Arguments ----------------------------------------
     p_grade = sp.add_parser("grade")
     p_grade.add_argument("path", help = "path to repositories directory")
@@ -182,6 +575,8 @@ def main():
     p_grade.add_argument("gradebook", help = "path to gradebook file")
     p_grade.add_argument("--rubric", dest = "rubric",
             action = "store_true", help = "use rubric grading")
+    add_pipeline_arguments(p_grade,
+            help = "number of notebooks to grade at once")
     p_grade.set_defaults(subprogram = do_grade)
 
     # Commit Tool Arguments ----------------------------------------
@@ -189,16 +584,24 @@ def main():
     p_commit.add_argument("path", help = "path to repositories directory")
     p_commit.add_argument("file", help = "name of file to commit")
     p_commit.add_argument("message", help = "commit message")
+    p_commit.add_argument("--no-index", dest = "no_index",
+            action = "store_true", help = "commit without updating the "
+            "index; run 'git reset' before committing with git afterwards")
     p_commit.set_defaults(subprogram = do_commit)
 
     # Push Tool Arguments ----------------------------------------
     p_push = sp.add_parser("push")
     p_push.add_argument("path", help = "path to repositories directory")
+    p_push.add_argument("-j", "--jobs", type = int, default = 1,
+            help = "number of repositories to push at once")
+    p_push.add_argument("--retries", type = int, default = 3,
+            help = "number of times to retry a push that fails with a "
+            "network error")
     p_push.set_defaults(subprogram = do_push)
 
     # Parse arguments and run subprogram
-    args = ap.parse_args()
-    args.subprogram(args)
+    args = ap.parse_args(argv)
+    run_subprogram(args)
 
 
 if __name__ == "__main__":
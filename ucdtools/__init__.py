@@ -0,0 +1,27 @@
+"""This package contains the modules behind ucdtool.py and the notebook
+tools.
+
+Submodules are imported the first time they're used, as in
+
+    import ucdtools
+    ucdtools.git.clone(url, dest)
+
+so that scripts only pay for the dependencies (pygit2, nbformat, pandas) of
+the modules they actually use.
+"""
+import importlib
+
+__all__ = ["cache", "dates", "git", "io", "late", "notebook", "pipeline",
+        "scan", "timing"]
+
+# Validation policies for bulk runs (see notebook.validate()). They're here so
+# that argument parsers can list them without importing nbformat.
+VALIDATION_POLICIES = ("full", "sampled", "structural")
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__,
+        name))
@@ -0,0 +1,30 @@
+"""This module contains functions for reading and writing the JSON files that
+the tools keep alongside a directory of repos, such as manifests and caches.
+"""
+import json
+import os
+from pathlib import Path
+
+
+def read_json(path, default = None):
+    """Read a JSON file, or return the default if the file doesn't exist or
+    can't be parsed.
+    """
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    """Write a JSON file atomically, so that an interrupted run can't leave a
+    partly written file behind.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+
+    with open(tmp, "wt") as f:
+        json.dump(data, f, indent = 1, sort_keys = True)
+
+    os.replace(str(tmp), str(path))
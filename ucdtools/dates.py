@@ -0,0 +1,19 @@
+"""This module contains functions for reading due dates.
+
+It only needs the standard library, so commands that take a due date don't
+have to import pandas.
+"""
+from datetime import datetime
+
+
+def parse_due(text, year, tzinfo):
+    """Parse a due date in 'MM.DD hh:mm' format.
+    """
+    due = datetime.strptime(text, "%m.%d %H:%M").replace(year = year)
+
+    # pytz time zones have to be attached with localize(), or else they use
+    # the zone's historical local mean time offset.
+    if hasattr(tzinfo, "localize"):
+        return tzinfo.localize(due)
+
+    return due.replace(tzinfo = tzinfo)
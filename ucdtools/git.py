@@ -3,11 +3,41 @@ collections of git repos.
 """
 from datetime import datetime, timezone, timedelta
 from getpass import getpass
-from pathlib import Path
+import json
+import os
+from pathlib import Path, PurePosixPath
+import re
 import shutil
+import sys
+import threading
+import time
 
 import pygit2 as git
 
+from . import cache, timing
+
+# Name of the manifest file inside a directory of repos.
+MANIFEST_NAME = ".manifest.json"
+# Git errors that are worth retrying: network and server problems. Other
+# errors, such as a rejected push, failed authentication, or a bad
+# certificate, fail the same way every time.
+TRANSIENT_ERROR = re.compile(r"timed out|timeout|connection|could not "
+        r"resolve|failed to resolve|early eof|unexpected eof|unexpected "
+        r"disconnect|reset by peer|broken pipe|ssl error: syscall|temporar|"
+        r"\b(?:429|50[0234])\b",
+        re.IGNORECASE)
+
+# Name of the file inside a repo's git directory that marks the index as
+# older than HEAD, after commit_file().
+STALE_INDEX_NAME = "ucdtools-stale-index"
+
+
+def print_lines(*lines):
+    """Print lines with one write, so that lines printed by other threads
+    can't run into them. (print() writes the newline separately.)
+    """
+    sys.stdout.write("".join(line + "\n" for line in lines))
+
 
 def check_late(repo, deadline):
     """Check whether the latest commit in a repository is past the deadline.
@@ -25,6 +55,20 @@ def check_late(repo, deadline):
     return is_late
 
 
+def commit_info(repo):
+    """Get metadata for the head commit of a repository.
+
+    Returns a dict with the head OID, the author's timestamp and UTC offset
+    in minutes, and the number of commits reachable from the head. In a
+    shallow clone, the count only includes the commits that were fetched.
+    """
+    head = repo.get(repo.head.target)
+    count = sum(1 for _ in repo.walk(head.id, git.GIT_SORT_NONE))
+
+    return {"head": str(head.id), "time": head.author.time,
+            "offset": head.author.offset, "commits": count}
+
+
 def extract_repo_name(url):
     return url.rpartition("/")[-1].rpartition(".")[0]
 
@@ -42,32 +86,272 @@ def get_credentials(use_ssh = True):
     return cred
 
 
+class CredentialProvider:
+    """This class gets git credentials lazily, the first time a remote asks
+    for them.
+
+    The credentials are cached, so one provider can be shared by all of the
+    workers in a batch operation and the user is prompted at most once.
+    """
+
+    def __init__(self, use_ssh = True):
+        self.use_ssh = use_ssh
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = get_credentials(self.use_ssh)
+
+        return self._credentials
+
+
+class PushRejected(git.GitError):
+    """The remote refused to update a ref, for instance because of a
+    protected branch or a hook. Retrying won't help.
+    """
+
+
+class CountingCallbacks(git.RemoteCallbacks):
+    """Remote callbacks that count the bytes received by a fetch or clone
+    and sent by a push, and collect refs that the remote rejected.
+    """
+
+    def __init__(self, credentials = None):
+        super().__init__(credentials = credentials)
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.rejected = []
+
+    def push_update_reference(self, refname, message):
+        # libgit2 only reports rejected refs here, so the push itself
+        # doesn't fail.
+        if message is not None:
+            self.rejected.append((refname, message))
+
+    def transfer_progress(self, stats):
+        self.received_bytes = stats.received_bytes
+
+    def push_transfer_progress(self, objects_pushed, total_objects,
+            bytes_pushed):
+        self.sent_bytes = bytes_pushed
+
+
+class ProviderCallbacks(CountingCallbacks):
+    """Remote callbacks that get credentials from a CredentialProvider.
+    """
+
+    def __init__(self, provider):
+        super().__init__()
+        self.provider = provider
+
+    def credentials(self, url, username_from_url, allowed_types):
+        return self.provider.get()
+
+
+# Used when no credentials are passed to a function that needs them.
+DEFAULT_CREDENTIALS = CredentialProvider()
+
+
+def make_callbacks(credentials = None):
+    """Make remote callbacks from a CredentialProvider, a pygit2 credentials
+    object, or None for the default provider.
+    """
+    if credentials is None:
+        credentials = DEFAULT_CREDENTIALS
+
+    if isinstance(credentials, CredentialProvider):
+        return ProviderCallbacks(credentials)
+
+    return CountingCallbacks(credentials)
+
+
+def open_repo(path):
+    """Open the repository that contains the user-specified path.
+    """
+    return git.Repository(git.discover_repository(str(path)))
+
+
+def git_stamp(workdir):
+    """Get a stamp that changes whenever a repo's HEAD or branches might have
+    changed.
+
+    Moving HEAD rewrites '.git/HEAD' and updating a branch rewrites a file in
+    '.git/refs/heads', both through a rename, so the newest modification time
+    of those directories (and 'packed-refs') is enough.
+    """
+    gitdir = Path(workdir) / ".git"
+    paths = [gitdir, gitdir / "refs" / "heads", gitdir / "packed-refs"]
+
+    stamps = [os.stat(str(paths[0])).st_mtime_ns]
+    for p in paths[1:]:
+        try:
+            stamps.append(os.stat(str(p)).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+
+    return max(stamps)
+
+
+def head_oid(repo):
+    """Get the OID of a repo's HEAD as a string, or None if HEAD is unborn.
+    """
+    if repo.head_is_unborn:
+        return None
+
+    return str(repo.head.target)
+
+
+def read_manifest(path):
+    """Read the manifest of a directory of repos.
+
+    The manifest maps each repo's directory name to a dict with the student's
+    'email' and 'user', the remote 'url', the last known 'head' OID, and the
+    'stamp' from git_stamp() when the entry was last checked. An empty dict
+    is returned if the directory has no manifest.
+    """
+    return cache.read_json(Path(path) / MANIFEST_NAME, {})
+
+
+def update_manifest(path, entries):
+    """Add or update entries in the manifest of a directory of repos.
+
+    The entries map repo directory names to dicts of fields to set. The
+    'head' and 'stamp' fields are filled in by opening each repo.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+
+    for name, fields in entries.items():
+        entry = manifest.setdefault(name, {})
+        entry.update(fields)
+        entry["head"] = head_oid(git.Repository(str(path / name)))
+        entry["stamp"] = git_stamp(path / name)
+
+    cache.write_json(path / MANIFEST_NAME, manifest)
+
+    return manifest
+
+
+def scan_repo(path):
+    """Make a manifest entry for a directory, or return None if it isn't a
+    repo.
+
+    Nothing is known about the student, so 'email' and 'user' are None.
+    """
+    path = Path(path)
+    if not (path / ".git").is_dir():
+        return None
+
+    repo = git.Repository(str(path))
+    try:
+        url = repo.remotes["origin"].url
+    except KeyError:
+        url = None
+
+    return {"email": None, "user": None, "url": url,
+            "head": head_oid(repo), "stamp": git_stamp(path)}
+
+
 def discover_repos(path):
     """Discover all repositories at the user-specified path.
+
+    The directory is listed once, and the names are compared with the
+    manifest. Repos in the manifest are only revalidated if their stamp
+    changed since the manifest was written, so only new directories (for
+    instance, repos cloned by hand or by an interrupted run) are checked for
+    a repo and added. Repos that were removed are dropped. If there's no
+    manifest, one is written.
+
+    Returns a list of repos, sorted by directory name.
     """
     path = Path(path)
-    paths = (git.discover_repository(str(p)) for p in path.iterdir())
-    return (git.Repository(p) for p in paths)
+    manifest = read_manifest(path)
+    changed = False
+
+    with os.scandir(str(path)) as it:
+        names = {e.name for e in it
+            if not e.name.startswith(".") and e.is_dir()}
+
+    for name in names - manifest.keys():
+        entry = scan_repo(path / name)
+        if entry is not None:
+            manifest[name] = entry
+            changed = True
 
+    repos = []
+    for name, entry in sorted(manifest.items()):
+        if name not in names:
+            del manifest[name]
+            changed = True
+            continue
 
-def clone(url, dest, credentials = get_credentials(), use_cache = True):
+        try:
+            stamp = git_stamp(path / name)
+        except FileNotFoundError:
+            del manifest[name]
+            changed = True
+            continue
+
+        repo = git.Repository(str(path / name))
+        if stamp != entry.get("stamp"):
+            entry["head"] = head_oid(repo)
+            entry["stamp"] = stamp
+            changed = True
+
+        repos.append(repo)
+
+    if changed or not (path / MANIFEST_NAME).exists():
+        cache.write_json(path / MANIFEST_NAME, manifest)
+
+    return repos
+
+
+def clone(url, dest, credentials = None, use_cache = True,
+        reference = None, depth = 0, single_branch = False,
+        stage = timing.NULL_STAGE):
     """This function clones a git repository from a URL.
+
+    If the destination already exists, it is skipped when use_cache is set,
+    or else deleted and cloned again. To update an existing clone instead,
+    use update_repo().
+
+    If a reference repository is given (see init_reference()), the clone
+    borrows objects from it instead of downloading them.
+
+    A nonzero depth makes a shallow clone with only that many commits of
+    history (this requires pygit2 >= 1.14). With single_branch, only
+    'master' is fetched.
+
+    The bytes received are counted in the timing stage, if one is given.
     """
     dest = Path(dest)
 
     if dest.exists():
         if use_cache:
-            repo = git.discover_repository(str(dest))
-            print("Skipped '{}'".format(dest))
-            return git.Repository(repo)
+            print_lines("Skipped '{}'".format(dest))
+            return open_repo(dest)
         else:
             shutil.rmtree(dest)
 
-    callbacks = git.RemoteCallbacks(credentials = credentials)
+    callbacks = make_callbacks(credentials)
 
     #try:
-    repo = git.clone_repository(url, str(dest), callbacks = callbacks)
-    print("Cloned '{}'".format(dest))
+    if reference is None:
+        kwargs = {}
+        if depth:
+            kwargs["depth"] = depth
+        if single_branch:
+            kwargs["remote"] = single_branch_remote("master")
+
+        repo = git.clone_repository(url, str(dest), callbacks = callbacks,
+                **kwargs)
+    else:
+        repo = clone_with_reference(url, dest, reference, callbacks,
+                depth = depth, single_branch = single_branch)
+    stage.received(callbacks.received_bytes)
+    print_lines("Cloned '{}'".format(dest))
     return repo
 
     #except Exception as e:
@@ -76,9 +360,149 @@ def clone(url, dest, credentials = get_credentials(), use_cache = True):
     #    return None
 
 
+def single_branch_refspec(branch, remote = "origin"):
+    return "+refs/heads/{0}:refs/remotes/{1}/{0}".format(branch, remote)
+
+
+def single_branch_remote(branch):
+    """Make a callback for clone_repository() that creates a remote which
+    only fetches one branch.
+    """
+    def create_remote(repo, name, url):
+        return repo.remotes.create(name, url, single_branch_refspec(branch))
+
+    return create_remote
+
+
+def init_reference(url, path, credentials = None):
+    """Clone (or fetch, if it already exists) a bare reference repository.
+
+    The reference is usually the assignment template. Student repos cloned
+    with it only store the objects that aren't already in the reference.
+    """
+    path = Path(path)
+    callbacks = make_callbacks(credentials)
+
+    if path.exists():
+        repo = git.Repository(str(path))
+        repo.remotes["origin"].fetch(callbacks = callbacks)
+        return repo
+
+    return git.clone_repository(url, str(path), bare = True,
+            callbacks = callbacks)
+
+
+def clone_with_reference(url, dest, reference, callbacks,
+        branch = "master", depth = 0, single_branch = False):
+    """Clone a repository that borrows objects from a reference repository
+    through git alternates.
+
+    libgit2 can't clone with a reference directly, so this creates an empty
+    repository, points its alternates at the reference, and then fetches.
+    The reference's branches are copied to 'refs/reference/', so that fetch
+    negotiation tells the server those objects are already present.
+
+    Alternates are absolute paths, so the reference must not be moved or
+    deleted while the clone is in use.
+    """
+    dest = Path(dest)
+    repo = git.init_repository(str(dest))
+
+    try:
+        objects = Path(reference.path).resolve() / "objects"
+        info = Path(repo.path) / "objects" / "info"
+        info.mkdir(parents = True, exist_ok = True)
+        (info / "alternates").write_text(str(objects) + "\n")
+
+        # Reopen so that the object database picks up the alternates.
+        repo = git.Repository(repo.path)
+
+        for name in reference.listall_references():
+            if name.startswith(("refs/heads/", "refs/remotes/")):
+                target = reference.lookup_reference(name).resolve().target
+                new_name = "refs/reference/" + name.partition("/")[2]
+                repo.create_reference(new_name, target, force = True)
+
+        if single_branch:
+            remote = repo.remotes.create("origin", url,
+                    single_branch_refspec(branch))
+        else:
+            remote = repo.remotes.create("origin", url)
+
+        if depth:
+            remote.fetch(callbacks = callbacks, depth = depth)
+        else:
+            remote.fetch(callbacks = callbacks)
+
+        upstream = repo.branches.remote["origin/" + branch]
+        local = repo.create_branch(branch, upstream.peel())
+        local.upstream = upstream
+        repo.checkout(local)
+
+    except Exception:
+        shutil.rmtree(dest)
+        raise
+
+    return repo
+
+
+def update_repo(repo, credentials = None, remote = "origin",
+        branch = "master", stage = timing.NULL_STAGE):
+    """Fetch a remote into an existing repository and fast-forward a branch.
+
+    Only objects missing from the repository are transferred. Returns
+    'current' if the branch already matches the remote, 'updated' if it was
+    fast-forwarded, 'ahead' if it only has local commits, or 'diverged' if
+    both sides have new commits. The branch is left alone unless it can be
+    fast-forwarded. The bytes received are counted in the timing stage, if
+    one is given.
+    """
+    callbacks = make_callbacks(credentials)
+    repo.remotes[remote].fetch(callbacks = callbacks)
+    stage.received(callbacks.received_bytes)
+
+    local = repo.lookup_reference("refs/heads/" + branch)
+    upstream = repo.lookup_reference(
+            "refs/remotes/{}/{}".format(remote, branch))
+
+    if local.target == upstream.target:
+        return "current"
+
+    base = repo.merge_base(local.target, upstream.target)
+    if base == upstream.target:
+        return "ahead"
+    elif base != local.target:
+        return "diverged"
+
+    # Fast-forward: update the working tree first, so a conflict with local
+    # changes leaves the branch untouched.
+    repo.checkout_tree(repo.get(upstream.target))
+    local.set_target(upstream.target)
+
+    return "updated"
+
+
+def sync_index(repo):
+    """Reset the index of a repo to HEAD's tree if commit_file() left it
+    behind HEAD.
+
+    Returns True if the index was reset.
+    """
+    marker = Path(repo.path) / STALE_INDEX_NAME
+    if not marker.exists():
+        return False
+
+    repo.index.read_tree(repo.head.peel(git.Commit).tree)
+    repo.index.write()
+    marker.unlink()
+
+    return True
+
+
 def add(repo, path):
     """Add a file to the staging area of a repo.
     """
+    sync_index(repo)
     repo.index.add(path)
     repo.index.write()
 
@@ -89,24 +513,157 @@ def commit(repo, message, author = None, ref = "refs/heads/master"):
     if not author:
         author = repo.default_signature
 
+    # Otherwise the commit would revert the changes from commit_file().
+    sync_index(repo)
     tree = repo.index.write_tree()
 
+    # The parent is named by OID, which also works in shallow repos where
+    # the parent's own parents are missing.
     oid = repo.create_commit(ref, author, author, message, tree,
-            [repo.head.peel().hex])
+            [repo.head.target])
 
     repo.head.set_target(oid)
 
     return oid
 
 
-def push(repo, credentials = get_credentials(), remote = None,
+def commit_file(repo, path, message, author = None,
         ref = "refs/heads/master"):
+    """Commit one file from the working tree without using the index.
+
+    The file is written straight into the object database, and the new tree
+    is built from the parent commit's tree with only that file's entry
+    replaced. The on-disk index is never read or written, so the cost doesn't
+    depend on how many files are in the repo.
+
+    The index still holds the parent's tree afterwards, so 'git status' shows
+    the file's change reverted as staged, and committing from the index would
+    undo the commit. A marker is written in the git directory so that add()
+    and commit() reset the index to HEAD first; with the git command line,
+    run 'git reset' before committing.
+
+    Returns the OID of the new commit, or None if the file is unchanged.
+    """
+    if not author:
+        author = repo.default_signature
+
+    parent = repo.get(repo.lookup_reference(ref).target)
+
+    data = (Path(repo.workdir) / path).read_bytes()
+    blob = repo.create_blob(data)
+
+    parts = PurePosixPath(path).parts
+    tree = replace_tree_entry(repo, parent.tree, parts, blob)
+    if tree == parent.tree.id:
+        return None
+
+    oid = repo.create_commit(ref, author, author, message, tree,
+            [parent.id])
+    (Path(repo.path) / STALE_INDEX_NAME).write_text(str(oid) + "\n")
+
+    return oid
+
+
+def replace_tree_entry(repo, tree, parts, blob):
+    """Write a copy of a tree with the blob at a path replaced, and return the
+    new tree's OID.
+
+    The path is given as a sequence of parts. Only the trees along the path
+    are rewritten; a missing tree is treated as empty.
+    """
+    if tree is None:
+        builder = repo.TreeBuilder()
+        entry = None
+    else:
+        builder = repo.TreeBuilder(tree)
+        entry = tree[parts[0]] if parts[0] in tree else None
+
+    if len(parts) == 1:
+        # Keep the mode of an existing file, e.g. if it's executable.
+        if entry is None or entry.filemode == git.GIT_FILEMODE_TREE:
+            mode = git.GIT_FILEMODE_BLOB
+        else:
+            mode = entry.filemode
+        builder.insert(parts[0], blob, mode)
+    else:
+        if entry is None or entry.filemode != git.GIT_FILEMODE_TREE:
+            subtree = None
+        else:
+            subtree = repo.get(entry.id)
+        oid = replace_tree_entry(repo, subtree, parts[1:], blob)
+        builder.insert(parts[0], oid, git.GIT_FILEMODE_TREE)
+
+    return builder.write()
+
+
+def push(repo, credentials = None, remote = None,
+        ref = "refs/heads/master", stage = timing.NULL_STAGE):
     """Given a list of repositories, this function pushes commits in each
     one.
+
+    Raises PushRejected if the remote refused to update the ref. The bytes
+    sent are counted in the timing stage, if one is given.
     """
     if not remote:
         remote = repo.remotes["origin"]
 
-    callbacks = git.RemoteCallbacks(credentials = credentials)
+    callbacks = make_callbacks(credentials)
 
     remote.push([ref], callbacks)
+    stage.sent(callbacks.sent_bytes)
+
+    if callbacks.rejected:
+        raise PushRejected("; ".join("{} rejected: {}".format(*r)
+            for r in callbacks.rejected))
+
+
+def push_with_retry(repo, credentials = None, retries = 3,
+        backoff = 1.0, **kwargs):
+    """Push a repository, retrying failed pushes with exponential backoff.
+
+    Only transient errors (see TRANSIENT_ERROR) are retried; others, such as
+    a rejected push, are raised right away. After the nth failure, this
+    function waits backoff * 2^(n - 1) seconds before trying again. The last
+    error is raised if every attempt fails. Other keyword arguments are
+    passed on to push().
+    """
+    for attempt in range(retries + 1):
+        try:
+            return push(repo, credentials, **kwargs)
+        except git.GitError as e:
+            if (attempt == retries or isinstance(e, PushRejected)
+                    or not TRANSIENT_ERROR.search(str(e))):
+                raise
+            print_lines("Retrying '{}' ({})".format(repo.path, e))
+            time.sleep(backoff * 2 ** attempt)
+
+
+def read_push_journal(path):
+    """Read a push journal into a dict that maps repo names to the OID of the
+    last commit pushed.
+
+    The journal is a JSON Lines file, so later entries replace earlier ones.
+    A missing journal is treated as empty.
+    """
+    journal = {}
+    try:
+        with open(path, "rt") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Skip a line left partly written by an interrupted run.
+                    continue
+                journal[entry["repo"]] = entry["oid"]
+    except FileNotFoundError:
+        pass
+
+    return journal
+
+
+def write_push_journal(path, name, oid):
+    """Append an entry for a pushed repo to a push journal.
+    """
+    with open(path, "at") as f:
+        f.write(json.dumps({"repo": name, "oid": str(oid)}) + "\n")
+        f.flush()
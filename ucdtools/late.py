@@ -0,0 +1,109 @@
+"""This module contains functions for building a report of late submissions
+from the head commits of a directory of repos.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pandas as pd
+
+from . import cache
+from . import dates
+from . import git
+from . import io
+
+# Name of the commit metadata cache inside a directory of repos.
+LATE_CACHE_NAME = ".late_cache.json"
+
+# Columns of the data frame from collect_commits().
+COMMIT_COLUMNS = ["repo", "head", "time", "offset", "commits"]
+
+
+def collect_commits(path, repos, jobs = 1):
+    """Collect head commit metadata (see git.commit_info()) for repos in a
+    directory, as returned by git.discover_repos().
+
+    Metadata is cached in the directory, so on later runs only repos whose
+    HEAD changed are read again. HEAD is taken from the directory's manifest,
+    which discover_repos() keeps up to date. Up to 'jobs' repos are read at
+    once.
+
+    Returns a data frame with one row per repo and the COMMIT_COLUMNS, which
+    is empty if there are no repos. Repos without commits are left out.
+    """
+    path = Path(path)
+    cached = cache.read_json(path / LATE_CACHE_NAME, {})
+    manifest = git.read_manifest(path)
+
+    heads = {}
+    for repo in repos:
+        name = Path(repo.path).parent.name
+        if name in manifest:
+            heads[name] = (repo, manifest[name]["head"])
+        else:
+            heads[name] = (repo, git.head_oid(repo))
+
+    names = [name for name, (_, head) in heads.items() if head is not None]
+    todo = [(name, heads[name][0]) for name in names
+            if cached.get(name, {}).get("head") != heads[name][1]]
+
+    with ThreadPoolExecutor(max_workers = jobs) as pool:
+        infos = pool.map(git.commit_info, (repo for _, repo in todo))
+        for (name, _), info in zip(todo, infos):
+            cached[name] = info
+
+    # Drop cached repos that are no longer in the directory or have no
+    # commits.
+    cached = {name: cached[name] for name in names}
+    cache.write_json(path / LATE_CACHE_NAME, cached)
+
+    rows = [dict(cached[name], repo = name) for name in names]
+    return pd.DataFrame(rows, columns = COMMIT_COLUMNS)
+
+
+def read_extensions(path, year, tzinfo):
+    """Read a CSV file of extended due dates.
+
+    The file must have an 'email' column and a 'due' column with dates in
+    'MM.DD hh:mm' format. Returns a dict that maps repo names (the part of
+    the email before the '@') to due dates.
+    """
+    df = pd.read_csv(path, dtype = str)
+    names = io.split_emails(df["email"])
+    dues = (dates.parse_due(d, year, tzinfo) for d in df["due"])
+
+    return dict(zip(names, dues))
+
+
+def late_report(commits, due, grace = 0, extensions = None):
+    """Decide which commits were submitted late.
+
+    A commit is late if it's more than 'grace' minutes past the due date. The
+    extensions argument maps repo names to due dates that replace the
+    default.
+
+    Returns a copy of the data frame with columns 'submitted' (the commit
+    time, in the author's time zone), 'due', 'minutes_late', and 'late'.
+    """
+    extensions = extensions or {}
+    report = commits.copy()
+
+    report["submitted"] = [
+        datetime.fromtimestamp(t, timezone(timedelta(minutes = o)))
+        for t, o in zip(report["time"], report["offset"])
+    ]
+    dues = [extensions.get(name, due) for name in report["repo"]]
+    report["due"] = dues
+
+    late_by = [(s - d).total_seconds() / 60
+            for s, d in zip(report["submitted"], dues)]
+    report["minutes_late"] = [max(0, round(m)) for m in late_by]
+    # Set the type, since an empty column would otherwise be objects.
+    report["late"] = pd.Series([m > grace for m in late_by],
+            index = report.index, dtype = bool)
+
+    # Write times in ISO format, since each row can have its own time zone.
+    report["submitted"] = [s.isoformat() for s in report["submitted"]]
+    report["due"] = [d.isoformat() for d in report["due"]]
+
+    return report
@@ -1,10 +1,21 @@
 """This module contains functions for working with Jupyter notebooks.
 """
+import base64
+from collections import Counter, namedtuple
+import copy
+from functools import lru_cache
+import hashlib
+import io
+import json
 from pathlib import Path
 import re
+import uuid
 
 import nbformat as nb
 
+import ucdtools
+from . import scan, timing
+
 RUBRIC_CELL_TEMPLATE = (
     '<strong style="color:#F00">Rubric Grade</strong>\n'
     '\n'
@@ -31,42 +42,438 @@ EXERCISE_PATTERN = re.compile(
 )
 
 
-def init_rubric(path, in_glob = "hw*.ipynb", out_name = "feedback.ipynb"):
-    """Create a feedback file in a directory that already contains a notebook.
+# Bump this when the grade cell templates or the way they're inserted
+# change, so that prepare_repo() regenerates every feedback file.
+TEMPLATE_VERSION = 2
+
+# Statuses that prepare_repo() can return.
+PREPARE_STATUSES = ("created", "skipped", "edited", "no exercises",
+        "missing", "failed")
+
+PrepareResult = namedtuple("PrepareResult",
+        ["name", "status", "message", "record", "validation", "saved",
+            "timings"])
+
+# Validation policies for bulk runs. With 'sampled', every nth notebook gets
+# the full schema check (see validate()).
+VALIDATION_POLICIES = ucdtools.VALIDATION_POLICIES
+
+# How many checks validate() has run at each level and how many problems
+# they caught, in this process.
+VALIDATION_COUNTS = Counter()
+
+CELL_TYPES = ("code", "markdown", "raw")
+
+
+def blob_oid(path, chunk_size = 1 << 20):
+    """Compute the git blob OID of a file, without needing a repository.
+    """
+    path = Path(path)
+    sha = hashlib.sha1("blob {}\0".format(path.stat().st_size).encode())
+
+    with open(str(path), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def use_full_validation(policy, i, every = 10):
+    """Decide whether the ith notebook in a bulk run gets the full schema
+    check under a validation policy.
+    """
+    if policy not in VALIDATION_POLICIES:
+        raise ValueError("Unknown validation policy '{}'".format(policy))
+
+    return policy == "full" or (policy == "sampled" and i % every == 0)
+
+
+def prepare_repo(path, rubric = False, record = None, force = False,
+        full = True, max_output = None, timed = False, in_glob = "hw*.ipynb",
+        out_name = "feedback.ipynb"):
+    """Create a feedback file in a repo, with init_rubric() or
+    init_feedback().
+
+    The record is what this function returned for the repo last time, and
+    has the blob OIDs of the input notebook ('source') and the feedback file
+    ('output'), and the 'template' used. If the input and template haven't
+    changed, the repo is skipped. If the feedback file was edited since it
+    was created, it's left alone (status 'edited') unless force is set.
+
+    The full argument is passed on to validate(). If max_output is set,
+    outputs larger than that many bytes are shrunk with cap_outputs(). If
+    timed is set, each stage is timed (see the timing module).
+
+    This function doesn't raise errors, so that it can be used in a process
+    pool. Returns a PrepareResult with the repo's name, a status from
+    PREPARE_STATUSES, a message, a new record, the validation counts for the
+    repo, the number of output bytes saved, and a list of timing records
+    (None if timed isn't set).
     """
-    # Copy assignment notebook.
     path = Path(path)
+    before = Counter(VALIDATION_COUNTS)
+    recorder = timing.Recorder() if timed else None
+
+    try:
+        status, message, record, saved = _prepare_repo(path, rubric,
+                record or {}, force, full, max_output, recorder, in_glob,
+                out_name)
+    except Exception as e:
+        # Validation errors span many lines, so only keep the first.
+        status, message, record, saved = ("failed",
+                str(e).partition("\n")[0], None, 0)
+
+    validation = dict(VALIDATION_COUNTS - before)
+    timings = recorder.records if timed else None
+    return PrepareResult(path.name, status, message, record, validation,
+            saved, timings)
+
+
+def _prepare_repo(path, rubric, record, force, full, max_output, recorder,
+        in_glob, out_name):
+    template = "{}:{}".format("rubric" if rubric else "feedback",
+            TEMPLATE_VERSION)
+    if max_output:
+        template += ":cap={}".format(max_output)
+    out_path = path / out_name
+
     notebooks = list(path.glob(in_glob))
     if len(notebooks) < 1:
-        print("Missing notebook for '{}'".format(path.name))
+        return ("missing", "missing notebook", None, 0)
+
+    with timing.stage(recorder, path.name, "hash") as stage:
+        source = blob_oid(notebooks[0])
+        stage.read(notebooks[0])
+        output = None
+        if out_path.exists():
+            output = blob_oid(out_path)
+            stage.read(out_path)
+
+    if output is not None and output == record.get("output"):
+        if (source == record.get("source")
+                and template == record.get("template")):
+            return ("skipped", "notebook unchanged", record, 0)
+    elif output is not None and not force:
+        # The feedback file was edited, or wasn't created by this function,
+        # so it might have grades in it.
+        message = "'{}' was edited; use --force to replace it".format(
+                out_name)
+        return ("edited", message, record, 0)
+
+    with timing.stage(recorder, path.name, "read") as stage:
+        notebook = read_notebook(notebooks[0])
+        stage.read(notebooks[0])
+
+    with timing.stage(recorder, path.name, "insert"):
+        status = add_grade_cells(notebook, rubric)
+
+    saved = 0
+    if max_output:
+        with timing.stage(recorder, path.name, "cap"):
+            saved = cap_outputs(notebook, max_output)
+
+    with timing.stage(recorder, path.name, "validate"):
+        validate(notebook, full)
+
+    with timing.stage(recorder, path.name, "write") as stage:
+        write_notebook(notebook, out_path)
+        stage.wrote(out_path)
+
+    record = {"source": source, "template": template,
+            "output": blob_oid(out_path)}
+
+    message = {
+        "created": "",
+        "no exercises": "no cells tagged 'exercise'",
+    }[status]
+
+    return (status, message, record, saved)
+
+
+def read_notebook(path):
+    """Read a notebook file as nbformat version 4, without validating it.
+
+    nbformat.read() validates every notebook against the schema, which is
+    slow; validate() does that instead, according to the validation policy.
+    """
+    with open(str(path), "rt", encoding = "utf-8") as f:
+        notebook = nb.reader.reads(f.read())
+
+    if notebook.get("nbformat") != 4:
+        notebook = nb.convert(notebook, 4)
+
+    return notebook
+
+
+def write_notebook(notebook, path):
+    """Write a notebook file, without validating it (see read_notebook()).
+    """
+    text = nb.v4.writes(notebook)
+    if not text.endswith("\n"):
+        text += "\n"
+
+    with open(str(path), "wt", encoding = "utf-8") as f:
+        f.write(text)
+
+
+def structural_problems(notebook):
+    """Do a quick check of the parts of a notebook's structure that editing
+    is likely to break.
+
+    This is much cheaper than the full schema check, but doesn't catch
+    everything. Returns a list of problems, which is empty if none were
+    found.
+    """
+    problems = []
+    if notebook.get("nbformat") != 4:
+        problems.append("nbformat is not 4")
+    if not isinstance(notebook.get("metadata"), dict):
+        problems.append("notebook metadata is not a dict")
+
+    cells = notebook.get("cells")
+    if not isinstance(cells, list):
+        problems.append("cells is not a list")
+        return problems
+
+    needs_id = uses_cell_ids(notebook)
+    for i, cell in enumerate(cells):
+        cell_type = cell.get("cell_type")
+        if cell_type not in CELL_TYPES:
+            problems.append("cell {} has bad type {!r}".format(i, cell_type))
+        if not isinstance(cell.get("metadata"), dict):
+            problems.append("cell {} metadata is not a dict".format(i))
+        if not isinstance(cell.get("source"), (str, list)):
+            problems.append("cell {} source is not text".format(i))
+        if needs_id and "id" not in cell:
+            problems.append("cell {} has no id".format(i))
+        elif not needs_id and "id" in cell:
+            problems.append("cell {} has an id before nbformat 4.5".format(i))
+        if (cell_type == "code") != isinstance(cell.get("outputs"), list):
+            problems.append("cell {} has bad outputs".format(i))
+
+    return problems
+
+
+def validate(notebook, full = True):
+    """Validate a notebook before writing it.
+
+    A cheap structural check (see structural_problems()) always runs. The
+    full nbformat schema check runs if full is set, or if the structural
+    check found problems. The schema check has the final say, so structural
+    problems that the schema allows are only counted as false alarms.
+
+    The checks are counted in VALIDATION_COUNTS. Raises
+    nbformat.ValidationError if the notebook is invalid.
+    """
+    VALIDATION_COUNTS["structural"] += 1
+    problems = structural_problems(notebook)
+
+    if not (full or problems):
         return
 
-    notebook = nb.read(str(notebooks[0]), 4)
+    VALIDATION_COUNTS["full"] += 1
+    try:
+        nb.validate(notebook)
+    except nb.ValidationError:
+        if problems:
+            VALIDATION_COUNTS["caught by structural"] += 1
+        else:
+            VALIDATION_COUNTS["caught by full only"] += 1
+        raise
 
-    text = RUBRIC_CELL_TEMPLATE
-    cell = nb.v4.new_markdown_cell(text)
-    cell["metadata"]["tags"] = ["grade"]
-    notebook["cells"].insert(0, cell)
+    if problems:
+        VALIDATION_COUNTS["structural false alarms"] += 1
 
-    nb.validate(notebook)
-    nb.write(notebook, str(path / out_name))
+
+def format_validation_counts(counts):
+    """Format validation counts (see validate()) as a one-line summary.
+    """
+    keys = ["structural", "full", "caught by structural",
+            "caught by full only", "structural false alarms"]
+    return "Validation: " + ", ".join(
+            "{} {}".format(counts.get(k, 0), k) for k in keys)
 
 
-def init_feedback(path, in_glob = "hw*.ipynb", out_name = "feedback.ipynb"):
+def init_rubric(path, in_glob = "hw*.ipynb", out_name = "feedback.ipynb",
+        full = True):
     """Create a feedback file in a directory that already contains a notebook.
+
+    The full argument is passed on to validate(). Returns 'created', or
+    'missing' if there's no notebook.
     """
+    return init_notebook(path, True, in_glob, out_name, full)
+
+
+def init_feedback(path, in_glob = "hw*.ipynb", out_name = "feedback.ipynb",
+        full = True):
+    """Create a feedback file in a directory that already contains a notebook.
+
+    The full argument is passed on to validate(). Returns 'created', 'no
+    exercises' if the feedback file was created but the notebook has no
+    exercise cells, or 'missing' if there's no notebook.
+    """
+    return init_notebook(path, False, in_glob, out_name, full)
+
+
+def init_notebook(path, rubric, in_glob, out_name, full):
     # Copy assignment notebook.
     path = Path(path)
     notebooks = list(path.glob(in_glob))
     if len(notebooks) < 1:
-        print("Missing notebook for '{}'".format(path.name))
+        return "missing"
+
+    notebook = read_notebook(notebooks[0])
+    status = add_grade_cells(notebook, rubric)
+
+    validate(notebook, full)
+    write_notebook(notebook, path / out_name)
+
+    return status
+
+
+def add_grade_cells(notebook, rubric = False):
+    """Add grading cells to a notebook: a rubric cell at the top if rubric is
+    set, and otherwise a grade cell after each exercise cell.
+
+    Returns 'created', or 'no exercises' if the notebook needs grade cells
+    but has no exercise cells.
+    """
+    if rubric:
+        text = RUBRIC_CELL_TEMPLATE
+        cell = markdown_cell(text, {"tags": ["grade"]},
+                uses_cell_ids(notebook))
+        notebook["cells"].insert(0, cell)
 
-    notebook = nb.read(str(notebooks[0]), 4)
+        return "created"
 
     insert_grade_cells(notebook)
 
-    nb.validate(notebook)
-    nb.write(notebook, str(path / out_name))
+    if not any(has_tag("exercise", cell) for cell in notebook["cells"]):
+        return "no exercises"
+
+    return "created"
+
+
+def cap_outputs(notebook, max_bytes):
+    """Shrink cell outputs that are larger than max_bytes.
+
+    Text is truncated and PNG images are downsampled (if Pillow is
+    installed); anything else that's too large is dropped. Each change is
+    recorded in the cell's metadata, under 'ucdtools' and then 'capped'.
+
+    Returns the number of bytes saved, measured as the length of the
+    outputs' JSON.
+    """
+    saved = 0
+    for cell in notebook["cells"]:
+        changes = []
+        for i, output in enumerate(cell.get("outputs", [])):
+            before = len(json.dumps(output))
+            if before <= max_bytes:
+                continue
+
+            if output["output_type"] == "stream":
+                text = truncate_text(output["text"], max_bytes)
+                if text is not None:
+                    output["text"] = text
+                    changes.append({"output": i, "mime": "text/plain",
+                        "bytes": before, "action": "truncated"})
+            elif "data" in output:
+                changes.extend(cap_output_data(output, i, max_bytes))
+
+            saved += before - len(json.dumps(output))
+
+        if changes:
+            meta = cell["metadata"].setdefault("ucdtools", {})
+            meta.setdefault("capped", []).extend(changes)
+
+    return saved
+
+
+def cap_output_data(output, index, max_bytes):
+    """Shrink the MIME bundle of a display_data or execute_result output.
+
+    Returns a list of the changes made.
+    """
+    data = output["data"]
+    changes = []
+    for mime in list(data):
+        size = len(json.dumps(data[mime]))
+        if size <= max_bytes:
+            continue
+
+        action = "dropped"
+        if mime.startswith("text/"):
+            text = truncate_text(data[mime], max_bytes)
+            if text is None:
+                continue
+            data[mime] = text
+            action = "truncated"
+        elif mime == "image/png":
+            png = downsample_png(data[mime], max_bytes)
+            if png is None:
+                del data[mime]
+            else:
+                data[mime] = png
+                action = "downsampled"
+                # The old size is no longer accurate.
+                output.get("metadata", {}).pop(mime, None)
+        else:
+            del data[mime]
+
+        changes.append({"output": index, "mime": mime, "bytes": size,
+            "action": action})
+
+    if not data:
+        data["text/plain"] = "[Output removed because it was too large.]"
+
+    return changes
+
+
+def truncate_text(text, max_bytes):
+    """Truncate text (a string or list of lines) to max_bytes characters.
+
+    Returns None if the text is already short enough.
+    """
+    if isinstance(text, list):
+        text = "".join(text)
+    if len(text) <= max_bytes:
+        return None
+
+    return "{}\n[Truncated {} characters.]\n".format(text[:max_bytes],
+            len(text) - max_bytes)
+
+
+def downsample_png(data, max_bytes):
+    """Halve the size of a base64-encoded PNG image until it fits in
+    max_bytes.
+
+    Returns the new base64-encoded image, or None if Pillow isn't installed
+    or the image can't be made small enough.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    if isinstance(data, list):
+        data = "".join(data)
+
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(data)))
+    except (OSError, ValueError):
+        return None
+
+    while min(image.size) > 16:
+        image = image.resize((image.size[0] // 2, image.size[1] // 2))
+
+        buf = io.BytesIO()
+        image.save(buf, "PNG", optimize = True)
+        encoded = base64.b64encode(buf.getvalue()).decode("ascii")
+        if len(encoded) + 2 <= max_bytes:
+            return encoded
+
+    return None
 
 
 def has_tag(tag, cell):
@@ -74,77 +481,219 @@ def has_tag(tag, cell):
     return "tags" in metadata and tag in metadata["tags"]
 
 
-def insert_grade_cells(notebook):
-    i = 0
-    cells = notebook["cells"]
+def exercise_index(cells, pattern = EXERCISE_PATTERN, tag = "exercise"):
+    """Index the exercise cells in a list of cells.
+
+    Returns a list of (position, exercise, points) tuples, one for each cell
+    tagged with the tag (or any cell, if the tag is None) whose source
+    matches the pattern. The pattern's groups are the exercise and the
+    points; if it only has one group, the points are None.
+    """
+    index = []
+    for i, cell in enumerate(cells):
+        if tag is None or has_tag(tag, cell):
+            m = pattern.search(cell["source"])
+            if m:
+                points = m.group(2) if pattern.groups > 1 else None
+                index.append((i, m.group(1), points))
 
-    while i < len(cells):
-        cell = cells[i]
+    return index
 
-        if has_tag("exercise", cell):
-            # Exercise Cell
-            j = i + 1
-            if j < len(cells) and has_tag("grade", cells[j]):
-                # Already has a grade cell, so do nothing.
-                pass
-            else:
-                # Insert a new grade cell.
-                try:
-                    grade_cell = new_grade_cell(cell)
-                    cells.insert(j, grade_cell)
-                except AttributeError as e:
-                    pass
 
-            i += 2
+def interleave_cells(cells, inserts, before = False):
+    """Build a new list of cells with new cells placed among the old ones.
 
-        else:
-            i += 1
+    The inserts map positions in the old list to new cells. Each new cell is
+    placed right after the cell at its position, or right before it if
+    before is set. This takes one pass, unlike calling insert() in a loop.
+    """
+    result = []
+    for i, cell in enumerate(cells):
+        new = inserts.get(i)
+        if new is not None and before:
+            result.append(new)
+        result.append(cell)
+        if new is not None and not before:
+            result.append(new)
+
+    return result
+
+
+def insert_grade_cells(notebook, index = None):
+    """Insert a grade cell after every exercise cell that doesn't already
+    have one.
+
+    The index is from exercise_index(), and is computed if not given. Returns
+    the number of grade cells inserted.
+    """
+    cells = notebook["cells"]
+    if index is None:
+        index = exercise_index(cells)
 
+    with_id = uses_cell_ids(notebook)
+    inserts = {}
+    for i, ex, points in index:
+        if i + 1 < len(cells) and has_tag("grade", cells[i + 1]):
+            # Already has a grade cell, so do nothing.
+            continue
+        inserts[i] = grade_cell(ex, points, with_id)
 
-def new_grade_cell(exercise):
+    notebook["cells"] = interleave_cells(cells, inserts)
+
+    return len(inserts)
+
+
+def new_grade_cell(exercise, with_id = True):
     """Create a grade cell for an exercise cell."""
     m = EXERCISE_PATTERN.search(exercise["source"])
-    ex = m.group(1)
-    points = m.group(2)
+    return grade_cell(m.group(1), m.group(2), with_id)
 
-    text = GRADE_CELL_TEMPLATE.format(ex, points)
 
-    cell = nb.v4.new_markdown_cell(text)
-    cell["metadata"]["tags"] = ["grade"]
+def grade_cell(ex, points, with_id = True):
+    """Create a grade cell for an exercise number and points.
+
+    Set with_id to False for notebooks older than nbformat 4.5.
+    """
+    return markdown_cell(GRADE_CELL_TEMPLATE.format(ex, points),
+            {"tags": ["grade"]}, with_id)
+
+
+def markdown_cell(source, metadata = None, with_id = True):
+    """Create a markdown cell with the given source and metadata.
+
+    Set with_id to False for notebooks older than nbformat 4.5.
+    """
+    # nbformat validates every new cell, which is slow when there are many
+    # exercises, so copy a prototype cell instead.
+    cell = copy.deepcopy(markdown_cell_prototype())
+    cell["source"] = source
+    cell["metadata"].update(copy.deepcopy(metadata or {}))
+    set_cell_id(cell, with_id)
 
     return cell
 
 
-def compute_grade(path):
+def uses_cell_ids(notebook):
+    """Check whether a notebook's format version requires cell ids (4.5 and
+    later) rather than forbidding them.
+    """
+    return notebook.get("nbformat_minor", 0) >= 5
+
+
+def set_cell_id(cell, with_id):
+    """Give a new cell a fresh id, or remove its id if with_id is False."""
+    if with_id:
+        cell["id"] = uuid.uuid4().hex[:8]
+    else:
+        cell.pop("id", None)
+
+
+@lru_cache(maxsize = None)
+def markdown_cell_prototype():
+    return nb.v4.new_markdown_cell("")
+
+
+def find_grade_cell(path):
+    """Find the first cell tagged 'grade' in a notebook file.
+
+    The file is scanned without parsing cell outputs (see scan.py). If that
+    doesn't find the cell, the whole notebook is read with nbformat instead.
+    Returns None if there's no grade cell.
+    """
+    try:
+        cell = scan.find_tagged_cell(path, "grade")
+    except (ValueError, IndexError):
+        cell = None
+
+    if cell is None:
+        notebook = nb.read(str(path), 4)
+        cell = next(
+                (cell for cell in notebook.cells if has_tag("grade", cell)),
+                None
+        )
+
+    return cell
+
+
+GradeResult = namedtuple("GradeResult",
+        ["name", "grade", "scores", "errors", "oid"])
+
+
+def grade_repo(path, record = None, name = "feedback.ipynb"):
+    """Compute the grade in a repo's feedback notebook.
+
+    The record is what this function returned for the repo last time, as a
+    dict. If the feedback notebook's blob OID hasn't changed, the record is
+    returned instead of parsing the notebook again.
+
+    This function doesn't raise errors, so that it can be used in a process
+    pool. Returns a GradeResult with the repo's name, the grade (None if it
+    couldn't be computed), a dict of scores for each rubric category, a list
+    of errors, and the notebook's blob OID.
+    """
     path = Path(path)
     try:
-        notebook = nb.read(str(path / "feedback.ipynb"), 4)
+        oid = blob_oid(path / name)
     except FileNotFoundError:
-        print("No feedback notebook '{}'".format(path))
-        return (path.name, None)
+        return GradeResult(path.name, None, {}, ["no feedback notebook"],
+                None)
+
+    if record is not None and record.get("oid") == oid:
+        return GradeResult(path.name, record["grade"], record["scores"],
+                record["errors"], oid)
 
-    # For rubric grading, the first 'grade' cell is the only one.
+    scores = {}
     try:
-        grade_cell = next(
-                cell for cell in notebook.cells if has_tag("grade", cell)
-        )
-    except StopIteration:
-        print("No grade cell '{}'".format(path))
-        return (path.name, None)
+        # For rubric grading, the first 'grade' cell is the only one.
+        cell = find_grade_cell(path / name)
+        if cell is None:
+            errors = ["no grade cell"]
+        else:
+            scores, errors = parse_rubric(cell["source"])
+    except Exception as e:
+        errors = [str(e).partition("\n")[0]]
+
+    grade = None
+    if scores and not errors:
+        grade = sum(scores.values())
+
+    return GradeResult(path.name, grade, scores, errors, oid)
+
 
+def parse_rubric(source):
+    """Parse the score table in the source of a rubric grade cell.
+
+    Returns a dict of scores for each category and a list of errors.
+    """
     # Find the table in the grade cell.
-    lines = grade_cell["source"].split("\n")
-    start = next(i for i, l in enumerate(lines) if l.startswith("R1"))
-    end = next(i for i, l in enumerate(lines) if l.startswith("C2"))
-    lines = lines[start:(end + 1)]
+    lines = source.split("\n")
+    try:
+        start = next(i for i, l in enumerate(lines) if l.startswith("R1"))
+        end = next(i for i, l in enumerate(lines) if l.startswith("C2"))
+    except StopIteration:
+        return ({}, ["no score table"])
 
     # Extract the scores from the table.
-    scores = (l.split("|")[-1].strip() for l in lines)
-    try:
-        score = sum(float(s) for s in scores)
-    except ValueError:
-        print("Could not grade '{}'.".format(path))
-        score = None
+    scores = {}
+    bad = []
+    for line in lines[start:(end + 1)]:
+        cells = line.split("|")
+        category = cells[0].strip()
+        try:
+            scores[category] = float(cells[-1].strip())
+        except ValueError:
+            bad.append(category)
 
-    return (path.name, score)
+    errors = []
+    if bad:
+        errors.append("bad score for {}".format(", ".join(bad)))
+
+    return (scores, errors)
+
+
+def compute_grade(path):
+    result = grade_repo(path)
+    for error in result.errors:
+        print("{}{} '{}'".format(error[0].upper(), error[1:], path))
 
+    return (result.name, result.grade)
@@ -0,0 +1,50 @@
+"""This module contains a streaming pipeline for running a function over every
+repo or notebook in a class.
+
+A class-wide command is written as a chain of generators:
+
+    discover -> read -> transform -> write -> report
+
+The command generates one argument tuple per repo (discover), imap() calls a
+worker on each one (read, transform, and write happen in the worker, one
+notebook at a time), and the command reports each result as it arrives.
+Workers should return small results, such as a status and a few counts,
+rather than parsed notebooks.
+"""
+from collections import deque
+# The executors are looked up when they're used, since the process pool
+# imports multiprocessing.
+from concurrent import futures
+
+
+def imap(fn, items, jobs = 1, limit = None, threads = False):
+    """Generate fn(*item) for each argument tuple in items, in order.
+
+    With jobs > 1, the calls run in a pool of that many processes (or
+    threads, if threads is set). At most limit calls are in flight at once,
+    by default twice the number of jobs; items aren't taken from the input
+    until there's room, and results are held only until they're consumed.
+    With jobs <= 1, each call runs when its result is requested.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield fn(*item)
+        return
+
+    if limit is None:
+        limit = 2 * jobs
+    limit = max(limit, 1)
+
+    if threads:
+        executor = futures.ThreadPoolExecutor
+    else:
+        executor = futures.ProcessPoolExecutor
+    with executor(max_workers = jobs) as pool:
+        pending = deque()
+        for item in items:
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+            pending.append(pool.submit(fn, *item))
+
+        while pending:
+            yield pending.popleft().result()
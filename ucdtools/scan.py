@@ -0,0 +1,140 @@
+"""This module contains functions for finding cells in Jupyter notebook files
+without parsing the whole notebook.
+
+The notebook file is memory-mapped and scanned with regular expressions that
+skip over strings and nested values, so cell outputs (such as base64 images)
+are never decoded or copied into Python objects. Only the cells that might
+match are parsed with the json module.
+"""
+import json
+import mmap
+import re
+
+# Characters that can start or end a string, object, or array.
+_STRUCTURE = re.compile(rb'["{}\[\]]')
+# Whitespace and separators between tokens.
+_SEPARATORS = re.compile(rb'[\s,:]*')
+# Numbers, true, false, and null.
+_SCALAR = re.compile(rb'[^\s,}\]]+')
+
+_QUOTE, _LBRACE, _LBRACKET, _RBRACE, _RBRACKET, _BACKSLASH = b'"{[}]\\'
+
+
+def skip_string(buf, pos):
+    """Return the position after the string whose opening quote is just
+    before pos.
+    """
+    # Searching for quotes with find() is much faster than a regular
+    # expression on long strings such as base64 images.
+    while True:
+        end = buf.find(b'"', pos)
+        if end == -1:
+            raise ValueError("Unterminated string at {}".format(pos))
+
+        # The quote is escaped if it follows an odd number of backslashes.
+        k = end
+        while buf[k - 1] == _BACKSLASH:
+            k -= 1
+        if (end - k) % 2 == 0:
+            return end + 1
+
+        pos = end + 1
+
+
+def skip_container(buf, pos):
+    """Return the position after the object or array that starts at pos.
+    """
+    depth = 0
+    while True:
+        m = _STRUCTURE.search(buf, pos)
+        if m is None:
+            raise ValueError("Unexpected end of notebook")
+
+        c = buf[m.start()]
+        pos = m.end()
+        if c == _QUOTE:
+            pos = skip_string(buf, pos)
+        elif c == _LBRACE or c == _LBRACKET:
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def skip_value(buf, pos):
+    """Return the position after the JSON value that starts at pos.
+    """
+    c = buf[pos]
+    if c == _QUOTE:
+        return skip_string(buf, pos + 1)
+    elif c == _LBRACE or c == _LBRACKET:
+        return skip_container(buf, pos)
+
+    return _SCALAR.match(buf, pos).end()
+
+
+def iter_cell_spans(buf):
+    """Generate the (start, end) positions of each cell in a notebook's JSON.
+    """
+    pos = _SEPARATORS.match(buf, 0).end()
+    if buf[pos] != _LBRACE:
+        raise ValueError("Notebook is not a JSON object")
+
+    # Find the 'cells' key at the top level.
+    pos += 1
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if buf[pos] == _RBRACE:
+            return
+        elif buf[pos] != _QUOTE:
+            raise ValueError("Expected a key at {}".format(pos))
+
+        end = skip_string(buf, pos + 1)
+        key = json.loads(buf[pos:end])
+        pos = _SEPARATORS.match(buf, end).end()
+        if key == "cells":
+            break
+
+        pos = skip_value(buf, pos)
+
+    if buf[pos] != _LBRACKET:
+        raise ValueError("Notebook cells are not a JSON array")
+
+    pos += 1
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if buf[pos] == _RBRACKET:
+            return
+
+        end = skip_container(buf, pos)
+        yield (pos, end)
+        pos = end
+
+
+def find_tagged_cell(path, tag):
+    """Find the first cell with a tag in a notebook file.
+
+    Cells that don't contain the tag anywhere in their JSON are skipped
+    without being parsed. The cell's source is joined into one string, as
+    nbformat does.
+
+    Returns the cell as a dict, or None if no cell has the tag. Raises
+    ValueError if the file can't be scanned.
+    """
+    needle = json.dumps(tag).encode()
+
+    with open(str(path), "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buf:
+            for start, end in iter_cell_spans(buf):
+                if buf.find(needle, start, end) == -1:
+                    continue
+
+                cell = json.loads(buf[start:end].decode("utf-8"))
+                if tag in cell.get("metadata", {}).get("tags", []):
+                    source = cell.get("source", "")
+                    if isinstance(source, list):
+                        cell["source"] = "".join(source)
+                    return cell
+
+    return None
@@ -0,0 +1,169 @@
+"""This module contains functions for timing each stage of the work on each
+repo, such as clone, read, validate, write, and push.
+
+Timing is off unless a Recorder is created. Code that does timed work takes
+an optional recorder and wraps each stage in stage(recorder, repo, name),
+which returns a shared do-nothing context when the recorder is None, so
+timing costs nothing when it's off.
+
+Records are plain dicts, so that workers in a process pool can return them
+to the main process.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Recorder:
+    """A list of timing records, one per stage per repo.
+    """
+    def __init__(self):
+        self.records = []
+
+    def extend(self, records):
+        """Add records returned by a worker.
+        """
+        if records:
+            self.records.extend(records)
+
+
+class Stage:
+    """A context that records how long a stage takes, and how many bytes it
+    reads and writes.
+    """
+    def __init__(self, recorder, repo, name):
+        self.recorder = recorder
+        self.record = {"repo": repo, "stage": name, "bytes_read": 0,
+                "bytes_written": 0}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.record.update(start = self.start, seconds = end - self.start,
+                pid = os.getpid(), thread = threading.get_ident())
+        # Appending to a list is atomic, so threads can share a recorder.
+        self.recorder.records.append(self.record)
+        return False
+
+    def read(self, path):
+        """Count the size of a file the stage read.
+        """
+        self.record["bytes_read"] += os.path.getsize(str(path))
+
+    def wrote(self, path):
+        """Count the size of a file the stage wrote.
+        """
+        self.record["bytes_written"] += os.path.getsize(str(path))
+
+    def received(self, n):
+        """Count bytes the stage received over the network as read.
+        """
+        self.record["bytes_read"] += n
+
+    def sent(self, n):
+        """Count bytes the stage sent over the network as written.
+        """
+        self.record["bytes_written"] += n
+
+
+class NullStage:
+    """A context that does nothing, used when timing is off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def read(self, path):
+        pass
+
+    def wrote(self, path):
+        pass
+
+    def received(self, n):
+        pass
+
+    def sent(self, n):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(recorder, repo, name):
+    """Return a context that times a stage of work on a repo, or does
+    nothing if the recorder is None.
+    """
+    if recorder is None:
+        return NULL_STAGE
+
+    return Stage(recorder, repo, name)
+
+
+def percentile(values, q):
+    """Compute the qth percentile of sorted values, by nearest rank.
+    """
+    k = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[k]
+
+
+def format_summary(records, slowest = 5):
+    """Format a table of time percentiles and bytes for each stage, followed
+    by the repos that took the longest in total.
+    """
+    if not records:
+        return "No timings recorded."
+
+    stages = {}
+    totals = {}
+    for r in records:
+        stages.setdefault(r["stage"], []).append(r)
+        totals[r["repo"]] = totals.get(r["repo"], 0) + r["seconds"]
+
+    lines = ["{:<10} {:>5} {:>9} {:>8} {:>8} {:>8} {:>8} {:>11} {:>11}"
+            .format("Stage", "Count", "Total (s)", "p50", "p90", "p99",
+                "Max", "Read (B)", "Wrote (B)")]
+    for name, rs in stages.items():
+        times = sorted(r["seconds"] for r in rs)
+        lines.append(
+            "{:<10} {:>5} {:>9.3f} {:>8.4f} {:>8.4f} {:>8.4f} {:>8.4f} "
+            "{:>11,} {:>11,}".format(name, len(times), sum(times),
+                percentile(times, 50), percentile(times, 90),
+                percentile(times, 99), times[-1],
+                sum(r["bytes_read"] for r in rs),
+                sum(r["bytes_written"] for r in rs)))
+
+    lines.append("\nSlowest repos:")
+    ranked = sorted(totals.items(), key = lambda x: x[1], reverse = True)
+    for repo, seconds in ranked[:slowest]:
+        lines.append("  {:.3f}s {}".format(seconds, repo))
+
+    return "\n".join(lines)
+
+
+def write_trace(records, path):
+    """Write records as a Chrome trace (JSON object format), which can be
+    opened in chrome://tracing or Perfetto.
+    """
+    origin = min((r["start"] for r in records), default = 0)
+    events = []
+    for r in records:
+        events.append({
+            "name": r["stage"],
+            "cat": "ucdtool",
+            "ph": "X",
+            "ts": (r["start"] - origin) * 1e6,
+            "dur": r["seconds"] * 1e6,
+            "pid": r["pid"],
+            "tid": r["thread"],
+            "args": {"repo": r["repo"], "bytes_read": r["bytes_read"],
+                "bytes_written": r["bytes_written"]},
+        })
+
+    with open(path, "wt") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)